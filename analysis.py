@@ -1,5 +1,3 @@
-import time
-
 import pandas as pd
 from site_fetching.get_coordinate import get_coordinates
 import geopy.distance
@@ -14,8 +12,10 @@ import plotly.graph_objects as go
 import matplotlib.pyplot as plt
 import os
 
-from fetchers.fetcher_csv import get_site_production, collect_data
+from fetchers.fetcher_csv import get_site_production
 from db.helper_db import run_query, run_queries
+from db.rollup import get_daily_efficiency
+from fetchers import ingest
 from misc.mapper import plot_map
 from misc.helper import time_batches, normalize, best_fit_curve
 import misc.helper
@@ -181,37 +181,16 @@ def plot_differences(solaredge_effs, solectria_effs):
     plt.show()
 
 
-def solectria_to_database(solectria_ids, start, end):
-    fetching_times = [] * len(solectria_ids)
-    for site_id in solectria_ids:
-        print('_____________________\nFetching site:', site_id)
-        t = time.time()
-        try:
-            if not collect_data(site_id, start, end, 60):
-                print("Fetching failed")
-        except Exception as e:
-            print('Error while fetching:', str(e))
-        t = time.time() - t
-        print("Total time:", t)
-        fetching_times.append(t)
-    print(solectria_ids)
-    print(fetching_times)
-
-
-def copy_from_main_db():
-    from fetchers.fetcher_csv import store
-    from math import ceil
-    site = run_query('SELECT * FROM site', retrieve=True)
-    store('site', site, bulk_load=True)
-    component_details = run_query('SELECT * FROM component_details', retrieve=True)
-    store('component_details', component_details, bulk_load=True)
-    n = run_query('SELECT count(*) FROM production')[0]['count']
-    l = 500000
-    for i in range(ceil(n / l)):
-        production = run_query('SELECT * FROM production LIMIT {} OFFSET {}'.format(l, i * l), retrieve=True)
-        production.fillna(0, inplace=True)
-        production["value"] = production["value"].astype(int)
-        store('production', production, bulk_load=True)
+# ingests sites with fetchers.ingest: 'workers' sites at a time, resumable, failed sites retried
+# incremental - only fetches production that is not in the database yet
+def solectria_to_database(solectria_ids, start, end, workers=8, incremental=True):
+    return ingest.run(solectria_ids, start, end, 60, workers, incremental=incremental)
+
+
+# copies sites, components and production from the main database (see db.replicate)
+def copy_from_main_db(workers=4):
+    from db.replicate import replicate
+    return replicate(['site', 'component_details', 'production'], workers)
 
 
 # converts production to power
@@ -262,11 +241,6 @@ def get_filename(site_id, start, end):
 def average_daily_efficiency(site_ids, start, end, interval):
     site_ids = list(map(str, site_ids))
 
-    site_metadatas = run_query(
-        'SELECT site_id, size FROM site '
-        'WHERE site_id IN ' + '(' + ("'{}', " * len(site_ids))[:-2].format(*site_ids) + ')', True).set_index('site_id')
-    system_sizes = [float(site_metadatas['size'][str(id)]) for id in site_ids]
-
     if not os.path.exists(CACHE_DIR):
         os.makedirs(CACHE_DIR)
     existing_files = [CACHE_DIR + '/' + f for f in os.listdir(CACHE_DIR)]
@@ -281,46 +255,19 @@ def average_daily_efficiency(site_ids, start, end, interval):
         else:
             efficiencies[i] = pd.read_csv(expected_files[i]).set_index('date')
     if len(new_sites) > 0:
-        new_datas = run_query(
-            "SELECT site_id, date, value FROM pss.public.production "
-            "WHERE date >= '{start}'::timestamp and date < '{end}'::timestamp AND "
-            .format(start=str(start), end=str(end)) +
-            "site_id IN " + "(" + ("'{}', " * len(new_sites))[:-2].format(*new_sites) + ')', True)
-
-        daily_power_per_site = {}
-        n_elements_per_site = {}
-        daily_efficiency_per_site = {}
-        powers = df_to_power(new_datas, interval * 60)
-        for site_id, date, value in zip(powers['site_id'], powers['date'], powers['value']):
-            if not daily_power_per_site.get(site_id):
-                daily_power_per_site[site_id] = {}
-                n_elements_per_site[site_id] = {}
-            day = date._date_repr
-            if not daily_power_per_site[site_id].get(day):
-                daily_power_per_site[site_id][day] = value
-                n_elements_per_site[site_id][day] = 1
-                continue
-            daily_power_per_site[site_id][day] += value
-            n_elements_per_site[site_id][day] += 1
-
-        for site_id in daily_power_per_site:
-            daily_efficiency_per_site[site_id] = {}
-            for day in daily_power_per_site[site_id]:
-                daily_efficiency_per_site[site_id][day] = daily_power_per_site[site_id][day] \
-                                                          / n_elements_per_site[site_id][day] \
-                                                          / (system_sizes[new_sites[site_id]] * 1000)
-            efficiencies[new_sites[site_id]] = pd.DataFrame(data=list(daily_efficiency_per_site[site_id].values()),
-                                                            index=daily_efficiency_per_site[site_id].keys(),
-                                                            columns=['value'])
+        # one row per site and day, averaged by the database (see db.rollup)
+        daily_efficiencies = get_daily_efficiency(list(new_sites), start, end, interval)
+        for site_id, site_effs in daily_efficiencies.groupby('site_id'):
+            efficiencies[new_sites[site_id]] = site_effs.set_index('date')[['value']]
             efficiencies[new_sites[site_id]].to_csv(get_filename(site_id, start, end), index_label='date')
 
-    total_effs = efficiencies[0].rename(columns={"value": site_ids[0]}).transpose()
-    for i in range(1, len(efficiencies)):
-        try:
-            total_effs = total_effs.append(efficiencies[i].rename(columns={"value": site_ids[i]}).transpose(),
-                                           sort=True)
-        except AttributeError:
-            print("No data for site", site_ids[i])
+    total_effs = []
+    for site_id, site_effs in zip(site_ids, efficiencies):
+        if site_effs is None:
+            print("No data for site", site_id)
+            continue
+        total_effs.append(site_effs.rename(columns={"value": site_id}).transpose())
+    total_effs = pd.concat(total_effs, sort=True)  # all sites at once
     total_effs.fillna(0, inplace=True)
 
     return total_effs
@@ -362,9 +309,9 @@ if __name__ == '__main__':
     ttest_ind(solaredge_effs.transpose().mean(), solectria_effs.transpose().mean(), nan_policy='omit')
 
     solectria_size_effs = pd.concat([run_query(
-        'SELECT site_id, size FROM site '
-        'WHERE site_id IN ' + '(' + ("'{}', " * len(solectria_effs.index))[:-2].format(*solectria_effs.index) + ')',
-        True).set_index('site_id'), solectria_effs.transpose().mean()], ignore_index=False, axis=1)
+        'SELECT site_id, size FROM site WHERE site_id = ANY(%(site_ids)s)', True,
+        params={'site_ids': list(map(str, solectria_effs.index))}).set_index('site_id'),
+        solectria_effs.transpose().mean()], ignore_index=False, axis=1)
 
     plot_acf(diffs, lags=len(solectria_effs.columns) - 1, color='magenta', title='', zero=False)
     plt.ylabel('Average correlation coefficient (r)')
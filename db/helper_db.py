@@ -1,21 +1,49 @@
+import itertools
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 import pandas as pd
 from db.config_db import config_db
 
+try:
+    import duckdb
+except ImportError:  # local databases are SQLite files without duckdb
+    duckdb = None
+
 table_queries = {
     'component_production': ["""
         DROP TABLE IF EXISTS public.component_production CASCADE;
         """,
                              """
                              CREATE TABLE public.component_production(
-                                 id SERIAL PRIMARY KEY,
+                                 id SERIAL,
                                  component_id VARCHAR(100),
                                  date timestamp NOT NULL,
                                  value integer,
                                  unit VARCHAR(10),
-                                 created_on TIMESTAMP default NOW()
-                             );
+                                 created_on TIMESTAMP default NOW(),
+                                 PRIMARY KEY (id, date)
+                             ) PARTITION BY RANGE (date);
+                             """,
+                             """
+                             CREATE TABLE public.component_production_default PARTITION OF public.component_production
+                                 DEFAULT;
+                             """,
+                             """
+                             CREATE UNIQUE INDEX component_production_component_id_date_key
+                                 ON public.component_production (component_id, date);
+                             """,
+                             """
+                             CREATE INDEX component_production_date_brin_idx
+                                 ON public.component_production USING brin (date);
                              """],
     'component_details': ["""
         DROP TABLE IF EXISTS public.component_details CASCADE;
@@ -33,21 +61,35 @@ table_queries = {
                               is_energy_producing BOOLEAN, 
                               created_on TIMESTAMP default NOW()
                           );
+                          """,
+                          """
+                          CREATE UNIQUE INDEX IF NOT EXISTS component_details_manufacturers_component_id_idx
+                              ON public.component_details (manufacturers_component_id);
                           """],
     'weather': [""" DROP TABLE IF EXISTS public.weather;
         """,
                 """
                 CREATE TABLE weather
    (
-       id SERIAL PRIMARY KEY,
+       id SERIAL,
        site_id VARCHAR(30),
        date TIMESTAMP NOT NULL,
        temperature_ambient numeric,
        temperature_module numeric,
        irradiance numeric,
        wind_direction numeric,
-       wind_speed numeric
-   );
+       wind_speed numeric,
+       PRIMARY KEY (id, date)
+   ) PARTITION BY RANGE (date);
+                """,
+                """
+                CREATE TABLE public.weather_default PARTITION OF public.weather DEFAULT;
+                """,
+                """
+                CREATE UNIQUE INDEX weather_site_id_date_key ON public.weather (site_id, date);
+                """,
+                """
+                CREATE INDEX weather_date_brin_idx ON public.weather USING brin (date);
                 """],
     'production': ["""
         DROP TABLE IF EXISTS public.production CASCADE;
@@ -60,8 +102,17 @@ table_queries = {
                            value integer, 
                            unit VARCHAR(10),
                            created_on TIMESTAMP default NOW()
-                   );
+                   ) PARTITION BY RANGE (date);
                
+                   """,
+                   """
+                   CREATE TABLE public.production_default PARTITION OF public.production DEFAULT;
+                   """,
+                   """
+                   CREATE UNIQUE INDEX production_site_id_date_key ON public.production (site_id, date);
+                   """,
+                   """
+                   CREATE INDEX production_date_brin_idx ON public.production USING brin (date);
                    """],
     'site': [
         """DROP TABLE IF EXISTS public.site CASCADE; 
@@ -86,6 +137,9 @@ table_queries = {
             fetch_id VARCHAR(50),
             created_on TIMESTAMP default NOW()
             );
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS site_site_id_idx ON public.site (site_id);
         """],
     'site_owner': [""" DROP TABLE IF EXISTS public.site_owner CASCADE; 
         """,
@@ -96,11 +150,141 @@ table_queries = {
                        status VARCHAR(20),
                        created_on TIMESTAMP default NOW()
            
+                       );
+                   """],
+    'ingest_job': [""" DROP TABLE IF EXISTS public.ingest_job CASCADE;
+        """,
+                   """
+                   CREATE TABLE public.ingest_job (
+                       site_id VARCHAR(30),
+                       period_start TIMESTAMP NOT NULL,
+                       period_end TIMESTAMP NOT NULL,
+                       status VARCHAR(10) default 'pending',
+                       attempts integer default 0,
+                       duration numeric,
+                       bytes bigint,
+                       error VARCHAR,
+                       updated_on TIMESTAMP default NOW(),
+                       PRIMARY KEY (site_id, period_start, period_end)
                        );
                    """],
 }
 
+# rollups of production per site and of component_production per component (see db.rollup), e.g. 'production_daily'
+rollup_units = {'hourly': 'hour', 'daily': 'day', 'monthly': 'month'}
+rollup_keys = {'production': 'site_id VARCHAR(30)', 'component_production': 'component_id VARCHAR(100)'}
+for source in rollup_keys:
+    for suffix in rollup_units:
+        table_queries['{}_{}'.format(source, suffix)] = [
+            "DROP TABLE IF EXISTS public.{}_{} CASCADE;".format(source, suffix),
+            """
+            CREATE TABLE public.{table} (
+                {key},
+                date TIMESTAMP NOT NULL,
+                value_sum bigint,
+                value_count integer,
+                power_max numeric,
+                updated_on TIMESTAMP default NOW(),
+                PRIMARY KEY ({key_name}, date)
+                );
+            """.format(table='{}_{}'.format(source, suffix), key=rollup_keys[source],
+                       key_name=rollup_keys[source].split()[0])]
+
+
+# 'CREATE [UNIQUE] INDEX name ON table (columns)' of table_queries: groups UNIQUE, name, columns
+index_pattern = re.compile(r'CREATE (UNIQUE )?INDEX (?:IF NOT EXISTS )?(\w+)(?=\s+ON \S+(?: USING \w+)? \(([^)]*)\))')
+copy_chunksize = 50000  # rows serialized at a time when streaming a dataframe to COPY
+merge_batch_size = 250000  # rows staged and merged at a time by copy_merge()
+# unique keys of tables merged by copy_merge() instead of appended to
+merge_keys = {'production': ['site_id', 'date'], 'component_production': ['component_id', 'date'],
+              'weather': ['site_id', 'date']}
+
+config_file = './db/database.ini'
+db_params = None  # [postgresql] section of config_file, read once by get_db_params()
+# one pool of connections per process, shared by all threads; sized by the optional [pool] section of config_file:
+#   [pool]
+#   minconn=1
+#   maxconn=8
+pool = None  # see get_pool()
+pool_slots = None  # semaphore of maxconn, so threads wait for a free connection instead of getting a PoolError
+pool_lock = threading.Lock()
+pool_timeout = 60  # seconds to wait for a free connection
+pool_stats = {'checkouts': 0, 'wait': 0.0, 'in_use': 0, 'leaks': 0}  # see get_pool_stats()
+query_chunksize = 100000  # rows fetched at a time by iter_query()
+# optional local database used instead of PostgreSQL by run_query(), iter_query() and fetcher_csv.store(),
+# set by the [local] section of config_file (or use_local()):
+#   [local]
+#   path=local_db
+# -> local_db.duckdb (local_db.sqlite without duckdb), a replica filled by 'python -m db.local sync'
+local_path = None  # False if there is no local database, see get_local_path()
+local = None  # ('duckdb' or 'sqlite', connection), see get_local()
+local_lock = threading.RLock()  # the local connection is used by one thread at a time
+# pd.read_sql_query() wraps errors of SQLite in pandas' own DatabaseError
+local_errors = (sqlite3.Error, pd.io.sql.DatabaseError) + ((duckdb.Error,) if duckdb is not None else ())
+cursor_ids = itertools.count()  # for unique names of server-side cursors
+# queries take named parameters of psycopg2 instead of values formatted into their text, e.g.:
+#   run_query('SELECT * FROM site WHERE site_id = ANY(%(site_ids)s) AND size > %(size)s', True,
+#             params={'site_ids': ['4760', '4761'], 'size': 10})
+# lists are bound as one array to '= ANY(%(name)s)' (expanded into IN (?, ...) in the local database), so the text
+# of a query is the same for any number of sites and PostgreSQL prepares it once per connection (see execute())
+param_pattern = re.compile(r'= ANY\(%\((\w+)\)s\)|%\((\w+)\)s|%%')
+# names of timestamp columns, e.g. 'date', 'installation_date', 'created_on', 'period_start' (text in SQLite)
+timestamp_pattern = re.compile(r'(\w+_)?date$|\w+_on$|period_(start|end)$')
+preparable = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b', re.IGNORECASE)
+max_prepared = 200  # statements prepared per connection before they are all deallocated
+statement_ids = itertools.count()  # for unique names of prepared statements
+
+
+# connection of the pool that keeps its prepared statements: {command: (name, [parameter names])}
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+
+
+# file-like object over an iterator of strings, so cursor.copy_from() can stream text that is made on demand
+class IteratorFile:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.pos < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            self.buffer = self.buffer[self.pos:] + chunk
+            self.pos = 0
+        end = len(self.buffer) if size < 0 else self.pos + size
+        data = self.buffer[self.pos:end]
+        self.pos = end
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
 
+# yields rows of a dataframe as tab-separated CSV for COPY (see get_copy_query), 'chunksize' rows at a time,
+# so only one chunk is ever copied and serialized; columns: [index], *defaults, *columns
+# columns - columns of df to write, defaults - {column: value} added to every row
+def iter_copy_text(df, columns, defaults={}, index=False, chunksize=copy_chunksize):
+    for i in range(0, len(df), chunksize):
+        part = df.iloc[i:i + chunksize][columns]
+        for name, value in reversed(list(defaults.items())):
+            part.insert(0, name, value, allow_duplicates=True)
+        yield part.to_csv(sep='\t', header=False, index=index)
+
+
+# returns the COPY reading rows of iter_copy_text() into 'table': tab-separated CSV rather than the text format,
+# which would take the quotes of to_csv() around fields with tabs, newlines or quotes (and backslashes in any
+# field) as part of the data; empty fields are NULL
+def get_copy_query(table, columns):
+    return "COPY {} ({}) FROM STDIN WITH (FORMAT csv, DELIMITER E'\\t', NULL '')".format(table, ', '.join(columns))
+
+
+# drops and creates all tables of table_queries, see ensure_tables() for a database that has data
 def create_tables():
     queries = []
     for table in table_queries:
@@ -109,42 +293,497 @@ def create_tables():
     return True
 
 
+# returns the DELETE of rows of 'table' duplicating others in 'columns', keeping the last inserted row of each
+# (the one copy_merge() would have updated last); rows with the same key and date are in the same partition
+def get_dedup_query(table, columns):
+    return 'DELETE FROM public.{0} a USING public.{0} b WHERE {1} AND a.tableoid = b.tableoid AND a.ctid < b.ctid' \
+        .format(table, ' AND '.join('a.{0} = b.{0}'.format(column) for column in columns))
+
+
+# creates what table_queries define and the database doesn't have yet, without dropping anything (unlike
+# create_tables()): missing tables with their partitions and indexes, and missing indexes of existing tables
+# (duplicates of a new unique index are deleted first, see get_dedup_query)
+# tables - names in table_queries, all of them by default; returns names of the tables created
+# partitioned tables created before schema v2 should be converted before, see 'python -m db.partitions migrate'
+def ensure_tables(tables=None):
+    if is_local():  # tables of the local database are made by 'python -m db.local sync'
+        return []
+    rows = run_queries(["SELECT tablename AS name FROM pg_tables WHERE schemaname = 'public'",
+                        "SELECT indexname AS name FROM pg_indexes WHERE schemaname = 'public'"])
+    if rows is None:
+        raise RuntimeError('Could not read the tables of the database')
+    existing, indexes = [{row['name'] for row in result} for result in rows]
+    created = []
+    for table in tables or table_queries:
+        commands = []
+        for query in table_queries[table][1:]:  # without DROP TABLE
+            index = index_pattern.search(query)
+            if table not in existing:
+                commands.append(query)
+            elif index is not None and index.group(2) not in indexes:
+                if index.group(1):
+                    commands.append(get_dedup_query(table, [c.strip() for c in index.group(3).split(',')]))
+                commands.append(index_pattern.sub(r'CREATE \1INDEX IF NOT EXISTS \2', query))
+        if commands and run_queries(commands) is None:
+            raise RuntimeError('Could not create {} or its indexes'.format(table))
+        if table not in existing:
+            created.append(table)
+    return created
+
+
 def get_db_params():
-    return config_db(filename='./db/database.ini')
+    global db_params
+    if db_params is None:
+        db_params = config_db(filename=config_file)
+    return dict(db_params)
 
 
-# if retrieve == True, tries to return dataframe for each command; throws an error if one of the commands is not SELECT
-def run_queries(commands, retrieve=False):
+# returns (minconn, maxconn) from the [pool] section of config_file, or (1, 8) without it
+def get_pool_size():
+    try:
+        size = config_db(filename=config_file, section='pool')
+    except Exception:  # no [pool] section
+        size = {}
+    return int(size.get('minconn', 1)), int(size.get('maxconn', 8))
+
+
+def get_pool():
+    global pool, pool_slots
+    with pool_lock:
+        if pool is None:
+            minconn, maxconn = get_pool_size()
+            pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, connection_factory=PreparingConnection,
+                                                        **get_db_params())
+            pool_slots = threading.BoundedSemaphore(maxconn)
+        return pool
+
+
+# closes all connections of the pool, e.g. before exiting; connections still checked out are counted as leaks
+def close_pool():
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool_stats['leaks'] += pool_stats['in_use']
+            pool.closeall()
+            pool = None
+
+
+# returns a copy of the counters of the pool: connections checked out in total and right now ('in_use'),
+# seconds spent waiting for a free connection, and leaks: connections given back in the middle of a transaction
+# (which are rolled back) or never given back before close_pool()
+def get_pool_stats():
+    with pool_lock:
+        return dict(pool_stats)
+
+
+# connection from the pool, given back at the end of the block
+# usage:
+#   with connection() as conn:
+#       pd.read_sql_query(query, conn)
+@contextmanager
+def connection():
+    p = get_pool()
+    t = time.perf_counter()
+    if not pool_slots.acquire(timeout=pool_timeout):
+        raise psycopg2.pool.PoolError('No free connection in {}s'.format(pool_timeout))
     conn = None
     try:
-        params = get_db_params()
-        conn = psycopg2.connect(**params)
-        results = [] * len(commands)
-        if retrieve:
-            for command in commands:
-                results.append(pd.read_sql_query(command, conn))
-        else:
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            for command in commands:
-                cur.execute(command)
+        conn = p.getconn()
+        with pool_lock:
+            pool_stats['checkouts'] += 1
+            pool_stats['in_use'] += 1
+            pool_stats['wait'] += time.perf_counter() - t
+        yield conn
+    finally:
+        if conn is not None:
+            if not conn.closed and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()  # neither committed nor rolled back by the block
+                with pool_lock:
+                    pool_stats['leaks'] += 1
+            with pool_lock:
+                pool_stats['in_use'] -= 1
+            p.putconn(conn, close=bool(conn.closed))  # a broken connection is replaced by a new one
+        pool_slots.release()
+
+
+# cursor in a transaction that is committed at the end of the block, or rolled back if it raises
+# usage:
+#   with transaction() as cur:
+#       cur.execute(...)
+@contextmanager
+def transaction(cursor_factory=None):
+    with connection() as conn:
+        try:
+            with conn.cursor(cursor_factory=cursor_factory) as cur:
+                yield cur
+            conn.commit()
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+
+
+# returns (command with $1, $2, ... instead of named parameters, [parameter names]) for PREPARE
+def get_prepared_query(command):
+    names = []
+
+    def number(match):
+        if match.group(0) == '%%':
+            return '%'
+        name = match.group(1) or match.group(2)
+        if name not in names:
+            names.append(name)
+        position = '${}'.format(names.index(name) + 1)
+        return '= ANY({})'.format(position) if match.group(1) else position
+
+    return param_pattern.sub(number, command), names
+
+
+# cursor.execute() with named parameters; SELECT, INSERT, UPDATE and DELETE are prepared on the first execution
+# on a connection of the pool and only executed afterwards, so they are parsed and planned once per connection
+# (server-side cursors of iter_query() can't run prepared statements, so their parameters are only bound)
+def execute(cur, command, params=None):
+    prepared = getattr(cur.connection, 'prepared', None)
+    if params is None or prepared is None or cur.name is not None or not preparable.match(command):
+        cur.execute(command, params)
+        return
+    if command not in prepared:
+        if len(prepared) >= max_prepared:
+            cur.execute('DEALLOCATE ALL')
+            prepared.clear()
+        name = 'statement_{}'.format(next(statement_ids))
+        query, names = get_prepared_query(command)
+        cur.execute('PREPARE {} AS {}'.format(name, query))
+        prepared[command] = (name, names)
+    name, names = prepared[command]
+    cur.execute('EXECUTE {}{}'.format(name, ' ({})'.format(', '.join(['%s'] * len(names))) if names else ''),
+                [params[n] for n in names])
+
+
+def get_local_path():
+    global local_path
+    if local_path is None:
+        try:
+            local_path = config_db(filename=config_file, section='local')['path']
+        except Exception:  # no [local] section
+            local_path = False
+    return local_path
+
+
+def is_local():
+    return bool(get_local_path())
+
+
+# raises RuntimeError if the local database is used: 'what' (e.g. 'Ingesting') only runs on PostgreSQL, whose
+# SQL it uses (partitions, ON CONFLICT, interval arithmetic, ...)
+def require_postgres(what):
+    if is_local():
+        raise RuntimeError('{} needs PostgreSQL, not the local database {} (see the [local] section of {})'
+                           .format(what, get_local_path(), config_file))
+
+
+# returns names of the tables of the database (the local one if is_local()), e.g. to check for tables added
+# after the database was made
+def get_tables():
+    if not is_local():
+        query = "SELECT tablename AS name FROM pg_tables WHERE schemaname = 'public'"
+    elif get_local()[0] == 'sqlite':
+        query = "SELECT name FROM sqlite_master WHERE type = 'table'"
+    else:
+        query = 'SELECT table_name AS name FROM information_schema.tables'
+    rows = run_query(query)
+    if rows is None:
+        raise RuntimeError('Could not read the tables of the database')
+    return {row['name'] for row in rows}
+
+
+# switches to the local database at 'path' (without the extension), or back to PostgreSQL if None
+def use_local(path):
+    global local_path, local
+    with local_lock:
+        if local is not None:
+            local[1].close()
+        local_path, local = path or False, None
+
+
+# returns (engine, connection) of the local database: DuckDB if it is installed, SQLite otherwise
+def get_local():
+    global local
+    with local_lock:
+        if local is None:
+            if duckdb is not None:
+                local = ('duckdb', duckdb.connect(get_local_path() + '.duckdb'))
+            else:
+                local = ('sqlite', sqlite3.connect(get_local_path() + '.sqlite', check_same_thread=False))
+        return local
+
+
+# returns a new connection to the local database, for reading while the shared one is used by others
+def connect_local():
+    engine, conn = get_local()
+    return conn.cursor() if engine == 'duckdb' else sqlite3.connect(get_local_path() + '.sqlite')
+
+
+# returns (command with '?' instead of named parameters, [values]) for the local database: lists of
+# '= ANY(%(name)s)' become IN (?, ...), datetimes are text in SQLite
+def get_local_query(command, params, engine):
+    if params is None:
+        return command, []
+    values = []
+
+    def bind(match):
+        if match.group(0) == '%%':
+            return '%'
+        value = params[match.group(1) or match.group(2)]
+        value = list(value) if match.group(1) else [value]
+        values.extend(str(v) if engine == 'sqlite' and isinstance(v, datetime) else v for v in value)
+        return '?' if not match.group(1) else 'IN ({})'.format(', '.join(['?'] * len(value)) or 'NULL')
+
+    return param_pattern.sub(bind, command), values
+
+
+# converts timestamp columns (see timestamp_pattern) of a dataframe read from SQLite from text to datetimes
+def parse_local_dates(df):
+    for column in df.columns:
+        if timestamp_pattern.match(column) and df[column].dtype == object:
+            df[column] = pd.to_datetime(df[column])
+    return df
+
+
+# returns a row of SQLite as {column: value} with timestamps (see timestamp_pattern) as datetimes, not text
+def get_local_row(names, row):
+    return {name: pd.Timestamp(value).to_pydatetime() if isinstance(value, str) and timestamp_pattern.match(name)
+            else value for name, value in zip(names, row)}
+
+
+# returns the result of a SELECT on the local database as a dataframe; timestamp columns are datetimes like
+# in PostgreSQL (SQLite keeps them as text)
+def read_local(conn, command, values=()):
+    if duckdb is not None and isinstance(conn, duckdb.DuckDBPyConnection):
+        return conn.execute(command, values).df()
+    return parse_local_dates(pd.read_sql_query(command, conn, params=values))
+
+
+# same as run_queries(), on the local database
+def run_local_queries(commands, retrieve=False, params=None):
+    with local_lock:
+        engine, conn = get_local()
+        try:
+            if engine == 'duckdb':
+                conn.begin()
+            results = []
+            for command, values in zip(commands, params or [None] * len(commands)):
+                command, values = get_local_query(command, values, engine)
+                if retrieve:
+                    results.append(read_local(conn, command, values))
+                    continue
+                cur = conn.execute(command, values)
                 if cur.description:  # if 'description' is not None - there is something to fetch
+                    names = [column[0] for column in cur.description]
+                    results.append([get_local_row(names, row) for row in cur.fetchall()])
+                else:
+                    results.append(None)
+            conn.commit()
+            return results
+        except local_errors as error:
+            conn.rollback()
+            print(error)
+            return None
+
+
+# inserts a dataframe into 'table' of the local database (created from the dataframe if there's none),
+# replacing rows with the same 'key' columns (see merge_keys)
+def store_local(table, df, key=None):
+    if len(df) == 0:
+        return
+    staging = 'staging_' + table
+    columns = ', '.join(df.columns)
+    with local_lock:
+        engine, conn = get_local()
+        if engine == 'duckdb':
+            conn.register(staging, df)
+        else:
+            df.to_sql(staging, conn, if_exists='replace', index=False)
+        commands = ['CREATE TABLE IF NOT EXISTS {} AS SELECT * FROM {} LIMIT 0'.format(table, staging)]
+        if key:
+            commands.append('DELETE FROM {table} WHERE EXISTS (SELECT 1 FROM {staging} WHERE {same})'.format(
+                table=table, staging=staging,
+                same=' AND '.join('{0}.{2} = {1}.{2}'.format(staging, table, column) for column in key)))
+        commands.append('INSERT INTO {} ({}) SELECT {} FROM {}'.format(table, columns, columns, staging))
+        try:
+            if run_local_queries(commands) is None:
+                raise RuntimeError('Could not store {} in the local database'.format(table))
+        finally:
+            if engine == 'duckdb':
+                conn.unregister(staging)
+            else:
+                conn.execute('DROP TABLE IF EXISTS {}'.format(staging))
+
+
+# if retrieve == True, tries to return dataframe for each command; throws an error if one of the commands is not SELECT
+# all commands run in one transaction, on the local database if there is one (see is_local())
+# params - named parameters of each command (see param_pattern), e.g.: [{'site_id': '4760'}, None]
+def run_queries(commands, retrieve=False, params=None):
+    if is_local():
+        return run_local_queries(commands, retrieve, params)
+    return run_postgres_queries(commands, retrieve, params)
+
+
+# run_queries() on a connection from the pool
+def run_postgres_queries(commands, retrieve=False, params=None):
+    try:
+        results = []
+        with transaction(None if retrieve else psycopg2.extras.RealDictCursor) as cur:
+            for command, values in zip(commands, params or [None] * len(commands)):
+                execute(cur, command, values)
+                if retrieve:  # numeric columns are floats, like in pd.read_sql_query()
+                    results.append(pd.DataFrame.from_records(cur.fetchall(), coerce_float=True,
+                                                             columns=[column[0] for column in cur.description]))
+                elif cur.description:  # if 'description' is not None - there is something to fetch
                     results.append(cur.fetchall())
                 else:
                     results.append(None)
-            cur.close()
-        conn.commit()
         return results
     except psycopg2.DatabaseError as error:
         print(error)
         return None
-    finally:
-        conn = None
 
 
-def run_query(command, retrieve=False):
-    result = run_queries([command], retrieve)
+# chunksize - with retrieve == True, returns iter_query(command, chunksize) instead of one dataframe
+# params - named parameters of the command, e.g.: {'site_id': '4760'}
+def run_query(command, retrieve=False, chunksize=None, params=None):
+    if retrieve and chunksize:
+        return iter_query(command, chunksize, params=params)
+    result = run_queries([command], retrieve, None if params is None else [params])
     return None if result is None else result[0]
 
 
+# yields the result of a SELECT in dataframes of up to 'chunksize' rows read through a server-side cursor,
+# so only one chunk is in memory at a time (numeric columns are floats, not Decimals)
+# dtypes - {column: dtype} applied to every chunk, e.g.: {'value': 'int64'}
+# as_numpy - yields {column: numpy array} instead of dataframes
+# params - named parameters of the command, e.g.: {'site_ids': ['4760', '4761']}
+# usage:
+#   for chunk in iter_query('SELECT site_id, date, value FROM production'):
+#       ...
+def iter_query(command, chunksize=query_chunksize, dtypes=None, as_numpy=False, params=None):
+    if is_local():
+        return iter_local_query(command, chunksize, dtypes, as_numpy, params)
+    return iter_postgres_query(command, chunksize, dtypes, as_numpy, params)
+
+
+# iter_query() on the local database, through a connection of its own
+def iter_local_query(command, chunksize=query_chunksize, dtypes=None, as_numpy=False, params=None):
+    conn = connect_local()
+    try:
+        cur = conn.execute(*get_local_query(command, params, get_local()[0]))
+        names = [column[0] for column in cur.description]
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if len(rows) == 0:
+                break
+            df = parse_local_dates(pd.DataFrame.from_records(rows, columns=names, coerce_float=True))
+            if dtypes:
+                df = df.astype(dtypes)
+            yield {column: df[column].to_numpy() for column in df.columns} if as_numpy else df
+    finally:
+        conn.close()
+
+
+# iter_query() through a server-side cursor of PostgreSQL
+def iter_postgres_query(command, chunksize=query_chunksize, dtypes=None, as_numpy=False, params=None):
+    with connection() as conn:
+        try:
+            # the cursor only lives in the transaction, which is ended even if the caller stops iterating early
+            with conn.cursor(name='iter_query_{}'.format(next(cursor_ids))) as cur:
+                cur.itersize = chunksize
+                execute(cur, command, params)
+                while True:
+                    rows = cur.fetchmany(chunksize)
+                    if len(rows) == 0:
+                        break
+                    df = pd.DataFrame.from_records(rows, columns=[column[0] for column in cur.description],
+                                                   coerce_float=True)
+                    if dtypes:
+                        df = df.astype(dtypes)
+                    yield {column: df[column].to_numpy() for column in df.columns} if as_numpy else df
+            conn.commit()
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+
+
+# inserts dataframe into 'table' in one statement: COPY into a temporary staging table, then INSERT ... SELECT
+# on_conflict - what to do with rows violating a unique index, e.g.: 'ON CONFLICT DO NOTHING'
+# index_label - column to put the index into, if None the index is not inserted
+def copy_upsert(table, df, on_conflict='ON CONFLICT DO NOTHING', index_label=None):
+    if len(df) == 0:
+        return
+    if is_local():  # rows are only added by the registry, after checking they are new
+        store_local(table, df.rename_axis(index_label).reset_index() if index_label else df)
+        return
+    columns = ([index_label] if index_label else []) + list(df.columns)
+    output = IteratorFile(iter_copy_text(df, list(df.columns), index=index_label is not None))
+    with transaction() as cur:
+        staging = 'staging_' + table
+        cur.execute('CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP'.format(staging, table))
+        cur.copy_expert(get_copy_query(staging, columns), output)
+        cur.execute('INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} {on_conflict}'.format(
+            table=table, columns=', '.join(columns), staging=staging, on_conflict=on_conflict))
+
+
+# returns the INSERT merging rows of 'staging' into 'table' by its unique 'key' columns:
+# new rows are inserted, changed ones updated, and rows that are already stored as they are aren't written at all
+# key - None for tables without a key in merge_keys, whose rows are inserted unless they violate a unique index
+def get_merge_query(table, staging, columns, key):
+    if key is None:
+        return 'INSERT INTO {} ({}) SELECT {} FROM {} ON CONFLICT DO NOTHING'.format(
+            table, ', '.join(columns), ', '.join(columns), staging)
+    values = [column for column in columns if column not in key]
+    merge = ("INSERT INTO {table} ({columns}) SELECT DISTINCT ON ({key}) {columns} FROM {staging} "
+             "ORDER BY {key}, ctid DESC "  # the last of duplicated rows of the batch
+             "ON CONFLICT ({key}) DO ".format(table=table, columns=', '.join(columns), key=', '.join(key),
+                                              staging=staging))
+    if values:
+        merge += "UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})".format(
+            ', '.join('{0} = EXCLUDED.{0}'.format(column) for column in values),
+            ', '.join('{}.{}'.format(table, column) for column in values),
+            ', '.join('EXCLUDED.' + column for column in values))
+    else:
+        merge += 'NOTHING'
+    return merge
+
+
+# returns the statement creating a temporary staging table with 'columns' of 'table' (only the columns,
+# without NOT NULL of the columns that are not copied), dropped at the end of the transaction
+def get_staging_query(table, staging, columns):
+    return 'CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA'.format(
+        staging, ', '.join(columns), table)
+
+
+# merges text rows for COPY (e.g. from iter_copy_text) into 'table' by its unique 'key' columns, in one transaction:
+# every merge_batch_size rows are COPYed into a temporary staging table (not WAL-logged) and then merged
+# with get_merge_query(), so storing the same rows again doesn't duplicate them
+# columns - names of the columns of the rows, including 'key'; returns the number of rows inserted or updated
+def copy_merge(table, chunks, columns, key):
+    staging = 'staging_' + table
+    merge = get_merge_query(table, staging, columns, key)
+
+    chunks = iter(chunks)
+    n_rows = 0
+    with transaction() as cur:
+        cur.execute(get_staging_query(table, staging, columns))
+        while True:
+            batch = list(itertools.islice(chunks, max(1, merge_batch_size // copy_chunksize)))
+            if len(batch) == 0:
+                break
+            cur.copy_expert(get_copy_query(staging, columns), IteratorFile(batch), size=65536)
+            cur.execute(merge)
+            n_rows += cur.rowcount
+            cur.execute('TRUNCATE {}'.format(staging))
+    return n_rows
+
+
 if __name__ == '__main__':
     create_tables()
@@ -0,0 +1,67 @@
+import sys
+import time
+
+from db.helper_db import get_local_path, get_tables, iter_postgres_query, rollup_keys, rollup_units, \
+    run_local_queries, run_postgres_queries, store_local, use_local
+
+# local replica of the PostgreSQL tables used by the analysis (see the [local] section in helper_db), so
+# run_query(), average_daily_efficiency etc. run in-process and offline once it is synced
+# production stored locally doesn't refresh the rollups, so db.rollup.get_rollup reads the periods they don't
+# cover from the raw tables
+# usage:
+#   python -m db.local sync [path] [--full] - copies new rows from PostgreSQL (everything with --full)
+
+local_tables = ['site', 'component_details', 'production', 'component_production', 'weather'] + \
+               ['{}_{}'.format(source, suffix) for source in rollup_keys for suffix in rollup_units]
+dated_tables = [table for table in local_tables if table not in ['site', 'component_details']]
+
+
+# returns names of the tables of PostgreSQL, e.g. without the rollups if they were never created there
+def get_source_tables():
+    rows = run_postgres_queries(["SELECT tablename AS name FROM pg_tables WHERE schemaname = 'public'"])
+    if rows is None:
+        raise RuntimeError('Could not read the tables of PostgreSQL')
+    return {row['name'] for row in rows[0]}
+
+
+# copies 'tables' from PostgreSQL into the local database: tables with 'date' from the latest local date on
+# (which replaces the local rows of that date, e.g. a rollup of a period that was still filling up),
+# other tables and all tables with full=True entirely; tables PostgreSQL doesn't have are skipped
+# returns {table: rows copied}
+def sync(tables=local_tables, full=False):
+    existing = get_tables()
+    source = get_source_tables()
+    copied = {}
+    for table in tables:
+        if table not in source:
+            print('{}: not in PostgreSQL, skipped'.format(table))
+            continue
+        t = time.perf_counter()
+        query = 'SELECT * FROM public.{}'.format(table)
+        params = None
+        if table in existing and not full and table in dated_tables:
+            last = run_local_queries(['SELECT max(date) AS date FROM {}'.format(table)])
+            last = last[0][0]['date'] if last else None
+            if last is not None:
+                query += ' WHERE date >= %(last)s'
+                params = {'last': last}
+                run_local_queries(['DELETE FROM {} WHERE date >= %(last)s'.format(table)], params=[params])
+        elif table in existing:
+            run_local_queries(['DROP TABLE {}'.format(table)])
+        n_rows = 0
+        for chunk in iter_postgres_query(query, params=params):
+            store_local(table, chunk)
+            n_rows += len(chunk)
+        copied[table] = n_rows
+        print('{}: {} rows in {:.1f}s'.format(table, n_rows, time.perf_counter() - t))
+    return copied
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['sync']:
+        paths = [arg for arg in sys.argv[2:] if not arg.startswith('--')]
+        if paths:
+            use_local(paths[0])
+        if not get_local_path():
+            raise SystemExit('No local database: pass its path or add a [local] section to database.ini')
+        sync(full='--full' in sys.argv)
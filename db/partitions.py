@@ -0,0 +1,119 @@
+import sys
+import threading
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+from psycopg2 import sql
+
+from db.helper_db import ensure_tables, get_dedup_query, is_local, merge_keys, require_postgres, run_queries, \
+    run_query, table_queries
+
+# production, component_production and weather are partitioned by month of 'date' (schema v2, see table_queries):
+#   production -> production_y2020m01, production_y2020m02, ..., production_default
+# rows of months without a partition go to the default partition; ensure_partitions() creates the partitions
+# of a range before it is inserted, moving rows of those months out of the default partition if there are any
+# usage:
+#   python -m db.partitions migrate - converts tables created before v2 (copying their rows), adds their unique keys
+#                                     and creates the other tables and indexes that are missing (see ensure_tables)
+
+partitioned_tables = ['production', 'component_production', 'weather']
+serial_tables = ['component_production', 'weather']  # with an 'id SERIAL' column
+partitions = {}  # table: names of its partitions, loaded once per table
+partitions_lock = threading.Lock()
+
+
+def get_partition_name(table, month):
+    return '{}_y{:04d}m{:02d}'.format(table, month.year, month.month)
+
+
+def load_partitions(table):
+    rows = run_query("SELECT inhrelid::regclass::text AS name FROM pg_inherits "
+                     "WHERE inhparent = 'public.{}'::regclass".format(table))
+    if rows is None:
+        raise RuntimeError('Could not read partitions of ' + table)
+    return {row['name'].split('.')[-1] for row in rows}
+
+
+# creates monthly partitions of 'table' for [start, end) that don't exist yet (the local database has none)
+def ensure_partitions(table, start, end):
+    if is_local():
+        return
+    month = datetime(start.year, start.month, 1)
+    with partitions_lock:
+        if table not in partitions:
+            partitions[table] = load_partitions(table)
+        while month < end:
+            name = get_partition_name(table, month)
+            if name not in partitions[table]:
+                create_partition(table, name, month, month + relativedelta(months=1))
+                partitions[table] = load_partitions(table)  # also picks up ones created by other processes
+            month += relativedelta(months=1)
+
+
+# creates the partition of [start, end) and moves its rows from the default partition in one transaction
+# (attaching a partition fails while the default partition still has rows of its range)
+# names and bounds are quoted by psycopg2.sql: partition bounds can't be bound parameters
+def create_partition(table, name, start, end):
+    table, default, name = (sql.Identifier('public', t) for t in [table, table + '_default', name])
+    start, end = sql.Literal(start), sql.Literal(end)
+    run_queries([
+        sql.SQL('CREATE TABLE IF NOT EXISTS {} (LIKE {} INCLUDING DEFAULTS)').format(name, table),
+        sql.SQL('INSERT INTO {} SELECT * FROM {} WHERE date >= {} AND date < {}').format(name, default, start, end),
+        sql.SQL('DELETE FROM {} WHERE date >= {} AND date < {}').format(default, start, end),
+        sql.SQL('ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})').format(table, name, start, end)])
+
+
+# converts a table created before v2 into a partitioned one: the old table is renamed to '<table>_v1',
+# the v2 table is created with partitions for all months of the old rows, and the rows are copied
+# (one per key of merge_keys, the last inserted)
+# drop - drops '<table>_v1' afterwards
+def migrate_to_v2(table, drop=False):
+    require_postgres('Migrating to schema v2')
+    kind = run_query("SELECT relkind FROM pg_class WHERE oid = to_regclass('public.{}')".format(table))
+    if not kind or kind[0]['relkind'] == 'p':  # no such table or already partitioned
+        return False
+    old = table + '_v1'
+    renames = ['ALTER TABLE public.{} RENAME TO {}'.format(table, old)]
+    if table in serial_tables:  # the v2 table creates a constraint and a sequence with the same names
+        renames += ['ALTER TABLE public.{0} RENAME CONSTRAINT {1}_pkey TO {0}_pkey'.format(old, table),
+                    'ALTER SEQUENCE public.{}_id_seq RENAME TO {}_id_seq'.format(table, old)]
+    if run_queries(renames + table_queries[table][1:]) is None:  # without DROP TABLE
+        raise RuntimeError('Could not create the partitioned ' + table)
+
+    dates = run_query('SELECT min(date) AS start, max(date) AS end FROM public.{}'.format(old))
+    if dates and dates[0]['start'] is not None:
+        ensure_partitions(table, dates[0]['start'], dates[0]['end'] + relativedelta(seconds=1))
+    # one row per key, the last inserted like get_dedup_query() and copy_merge() keep
+    key = ', '.join(merge_keys[table])
+    copy = ['INSERT INTO public.{} SELECT DISTINCT ON ({key}) * FROM public.{} ORDER BY {key}, ctid DESC'
+            .format(table, old, key=key)]
+    if table in serial_tables:
+        copy.append("SELECT setval('public.{0}_id_seq', coalesce((SELECT max(id) FROM public.{0}), 0) + 1, false)"
+                    .format(table))
+    if drop:
+        copy.append('DROP TABLE public.{}'.format(old))
+    if run_queries(copy) is None:
+        raise RuntimeError('Could not copy rows of {} into the partitioned table'.format(old))
+    return True
+
+
+# removes duplicated rows of 'table' (keeping the last inserted one) and adds its unique key from merge_keys,
+# replacing the plain index of the first v2 schema
+def add_merge_key(table):
+    require_postgres('Adding unique keys')
+    key = merge_keys[table]
+    if run_queries([
+        get_dedup_query(table, key),
+        "DROP INDEX IF EXISTS public.{}_{}_idx".format(table, '_'.join(key)),
+        "CREATE UNIQUE INDEX IF NOT EXISTS {0}_{1}_key ON public.{0} ({2})".format(table, '_'.join(key),
+                                                                                  ', '.join(key))]) is None:
+        raise RuntimeError('Could not add the unique key of ' + table)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['migrate']:
+        for table in partitioned_tables:  # before ensure_tables(), which would add v2 indexes to v1 tables
+            print(table, 'migrated' if migrate_to_v2(table, '--drop' in sys.argv) else 'unchanged')
+        print('created:', ', '.join(ensure_tables()) or 'nothing')
+        for table in partitioned_tables:
+            add_merge_key(table)
@@ -0,0 +1,67 @@
+import threading
+
+import pandas as pd
+
+from db.helper_db import copy_upsert, run_query
+
+
+# components and sites already in the database, loaded with one query and checked in memory;
+# new ones are collected and inserted in one batch per table by flush()
+# usage:
+#   registry = Registry()
+#   if not registry.has_component(manuf_id):
+#       registry.add_component({'manufacturers_component_id': manuf_id, ...})
+#   registry.flush()
+# safe to share between threads
+class Registry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.components = None  # manufacturers_component_ids
+        self.sites = None  # site_ids as str
+        self.new_components = []  # rows of component_details
+        self.new_sites = []  # rows of site
+
+    def load(self):
+        rows = run_query("SELECT 'component' AS kind, manufacturers_component_id AS id FROM component_details "
+                         "UNION ALL SELECT 'site', site_id FROM site")
+        if rows is None:
+            raise RuntimeError('Could not load components and sites')
+        with self.lock:
+            self.components = {row['id'] for row in rows if row['kind'] == 'component'}
+            self.sites = {row['id'] for row in rows if row['kind'] == 'site'}
+
+    def has_component(self, manuf_id):
+        with self.lock:
+            if self.components is None:
+                self.load()
+            return str(manuf_id) in self.components
+
+    # row - dict of component_details columns, including 'manufacturers_component_id'
+    def add_component(self, row):
+        with self.lock:
+            if not self.has_component(row['manufacturers_component_id']):
+                self.components.add(str(row['manufacturers_component_id']))
+                self.new_components.append(row)
+
+    def has_site(self, site_id):
+        with self.lock:
+            if self.sites is None:
+                self.load()
+            return str(site_id) in self.sites
+
+    # row - dict of site columns, including 'site_id'
+    def add_site(self, row):
+        with self.lock:
+            if not self.has_site(row['site_id']):
+                self.sites.add(str(row['site_id']))
+                self.new_sites.append(row)
+
+    # inserts new components and sites, skipping those inserted by someone else meanwhile
+    def flush(self):
+        with self.lock:
+            new_components, new_sites = self.new_components, self.new_sites
+            self.new_components, self.new_sites = [], []
+        if new_components:
+            copy_upsert('component_details', pd.DataFrame(new_components))
+        if new_sites:
+            copy_upsert('site', pd.DataFrame(new_sites))
@@ -0,0 +1,228 @@
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
+from dateutil.relativedelta import relativedelta
+
+from db import partitions, rollup
+from db.config_db import config_db
+from db.helper_db import config_file, get_merge_query, get_staging_query, merge_keys, require_postgres, run_query, \
+    transaction
+
+# copies tables from the main database (the [main] section of database.ini) into this one (the [postgresql] section)
+# by piping COPY (SELECT ...) TO STDOUT of the source into COPY ... FROM STDIN of the target, so rows are never
+# parsed into python objects and only a few buffers are held in memory
+# tables with 'date' are copied in windows of one month (one partition, see db.partitions) at a time, by several
+# workers; every window is merged into the target in one transaction (see helper_db.get_merge_query), its rollups
+# are refreshed (see db.rollup) and it is recorded in progress_file, so an interrupted copy continues with the windows
+# that are not done, and a repeated one doesn't duplicate rows
+# only closed windows are recorded: the last month of a table (which the source may still be adding rows to) and
+# tables without 'date' are copied again by every run
+# usage:
+#   python -m db.replicate [workers]
+
+source_section = 'main'
+tables = ['site', 'component_details', 'production', 'component_production', 'weather']  # in this order
+window = relativedelta(months=1)
+pipe_size = 16  # buffers of the source waiting for the target
+progress_file = 'replication_progress.tsv'
+progress_lock = threading.Lock()
+
+
+# file-like object connecting two COPYs: written by the source's copy_expert in one thread, read by the target's
+# in another; at most pipe_size buffers are held
+class Pipe:
+    def __init__(self):
+        self.queue = queue.Queue(pipe_size)
+        self.buffer = b''
+        self.eof = False
+        self.aborted = False
+        self.n_bytes = 0
+
+    def write(self, data):
+        data = data if isinstance(data, bytes) else data.encode()
+        if not self.put(data):  # fails the source's COPY
+            raise IOError('Target stopped reading')
+        self.n_bytes += len(data)
+        return len(data)
+
+    # returns False if the target stopped reading
+    def put(self, data):
+        while not self.aborted:
+            try:
+                self.queue.put(data, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def close(self):
+        self.put(None)
+
+    def abort(self):
+        self.aborted = True
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.queue.get()
+            if data is None:
+                self.eof = True
+                break
+            self.buffer += data
+        size = len(self.buffer) if size < 0 else size
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def connect_source():
+    return psycopg2.connect(**config_db(filename=config_file, section=source_section))
+
+
+# returns columns of the table that are in both databases, except serial ids, which the target makes itself
+def get_columns(table):
+    query = ("SELECT column_name FROM information_schema.columns WHERE table_schema = 'public' "
+             "AND table_name = '{}' AND column_name != 'id' ORDER BY ordinal_position".format(table))
+    target = [row['column_name'] for row in run_query(query) or []]
+    conn = connect_source()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query)
+            source = {row[0] for row in cur.fetchall()}
+    finally:
+        conn.close()
+    return [column for column in target if column in source]
+
+
+# returns windows [(start, end), ...] of the table in the source: one month each for tables with 'date',
+# [(None, None)] for the others
+def get_windows(table, columns):
+    if 'date' not in columns:
+        return [(None, None)]
+    conn = connect_source()
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT min(date), max(date) FROM public.{}'.format(table))
+            first, last = cur.fetchone()
+    finally:
+        conn.close()
+    if first is None:
+        return []
+    windows = []
+    start = first.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while start <= last:
+        windows.append((start, start + window))
+        start += window
+    return windows
+
+
+def get_select(table, columns, start, end):
+    query = 'SELECT {} FROM public.{}'.format(', '.join(columns), table)
+    if start is not None:
+        query += " WHERE date >= '{}' AND date < '{}'".format(start, end)
+    return query
+
+
+# copies one window of the table; returns (rows merged, bytes piped, ids of the sites/components copied if the table
+# has rollups (see db.rollup), otherwise None)
+def copy_window(table, columns, start, end):
+    pipe = Pipe()
+    errors = []
+
+    def read_source():
+        conn = connect_source()
+        try:
+            with conn.cursor() as cur:
+                cur.copy_expert('COPY ({}) TO STDOUT'.format(get_select(table, columns, start, end)), pipe)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            pipe.close()
+            conn.close()
+
+    reader = threading.Thread(target=read_source, daemon=True)
+    reader.start()
+    staging = 'staging_' + table
+    try:
+        if table in partitions.partitioned_tables and start is not None:
+            partitions.ensure_partitions(table, start, end)
+        with transaction() as cur:
+            cur.execute(get_staging_query(table, staging, columns))
+            cur.copy_expert('COPY {} ({}) FROM STDIN'.format(staging, ', '.join(columns)), pipe, size=65536)
+            reader.join()
+            if errors:  # not committing a window that was only partly read
+                raise errors[0]
+            key_ids = None
+            if table in rollup.keys:
+                cur.execute('SELECT DISTINCT {} FROM {}'.format(rollup.keys[table], staging))
+                key_ids = [row[0] for row in cur.fetchall()]
+            cur.execute(get_merge_query(table, staging, columns, merge_keys.get(table)))
+            n_rows = cur.rowcount
+    except BaseException:
+        pipe.abort()
+        raise
+    finally:
+        reader.join()
+    return n_rows, pipe.n_bytes, key_ids
+
+
+def load_progress():
+    if not os.path.exists(progress_file):
+        return set()
+    with open(progress_file) as f:
+        return {tuple(line.split('\t')[:2]) for line in f if line.strip()}
+
+
+def save_progress(table, start, n_rows, n_bytes, seconds):
+    with progress_lock, open(progress_file, 'a') as f:
+        f.write('{}\t{}\t{}\t{}\t{:.3f}\n'.format(table, start, n_rows, n_bytes, seconds))
+
+
+# copies 'tables' from the source with 'workers' windows at a time (workers should not exceed the connection pool)
+# prints every window and the throughput of each table; returns {table: (rows merged, bytes piped, seconds)}
+def replicate(tables=tables, workers=4):
+    require_postgres('Replicating')  # the target is a PostgreSQL database, see db.local for the local one
+    done = load_progress()
+    report = {}
+    with ThreadPoolExecutor(workers) as pool:
+        for table in tables:  # one table at a time, so components are in the target before their production
+            t = time.perf_counter()
+            columns = get_columns(table)
+            windows = get_windows(table, columns)
+            closed = set(windows[:-1]) if windows and windows[-1][0] is not None else set()
+            windows = [(start, end) for start, end in windows
+                       if (start, end) not in closed or (table, str(start)) not in done]
+            print('{}: {} windows to copy'.format(table, len(windows)))
+
+            def run(start, end):
+                t_window = time.perf_counter()
+                n_rows, n_bytes, key_ids = copy_window(table, columns, start, end)
+                seconds = time.perf_counter() - t_window
+                print('  {} {}: {} rows, {:.1f} MB in {:.1f}s'.format(table, start, n_rows, n_bytes / 1e6, seconds))
+                return n_rows, n_bytes, seconds, key_ids
+
+            futures = {pool.submit(run, start, end): (start, end) for start, end in windows}
+            n_rows, n_bytes = 0, 0
+            for future in as_completed(futures):
+                rows, size, seconds, key_ids = future.result()
+                start, end = futures[future]
+                if key_ids is not None:  # in this thread, one window at a time; power_max stays as it was
+                    rollup.refresh(table, key_ids, start, end)
+                if (start, end) in closed:
+                    save_progress(table, start, rows, size, seconds)
+                n_rows, n_bytes = n_rows + rows, n_bytes + size
+            seconds = time.perf_counter() - t
+            report[table] = (n_rows, n_bytes, seconds)
+            print('{}: {} rows, {:.1f} MB in {:.1f}s ({:.1f} MB/s)'.format(
+                table, n_rows, n_bytes / 1e6, seconds, n_bytes / 1e6 / max(seconds, 1e-9)))
+    return report
+
+
+if __name__ == '__main__':
+    replicate(workers=int(sys.argv[1]) if len(sys.argv) > 1 else 4)
@@ -0,0 +1,214 @@
+from datetime import time
+
+import pandas as pd
+
+from db.helper_db import ensure_tables, get_local, get_tables, is_local, rollup_units, run_queries, run_query
+
+# hourly, daily and monthly rollups of 'production' per site and 'component_production' per component, e.g.:
+#   production_hourly (site_id, date, value_sum, value_count, power_max)
+# with the sum of Wh, the number of rows and the max power in W of each hour, so statistics over long ranges
+# are read from one row per site and hour/day/month instead of every raw row
+# refresh() recomputes whole periods (hours from the raw table, days from hours, months from days),
+# so it can be run again after any ingest; 'python -m db.rollup' rebuilds everything, e.g. after creating the tables
+
+keys = {'production': 'site_id', 'component_production': 'component_id'}
+unit_minutes = {'hour': 60, 'day': 24 * 60}  # months are not a fixed number of minutes
+unit_freq = {'hour': 'H', 'day': 'D'}  # of pandas
+tables = ['{}_{}'.format(table, suffix) for table in keys for suffix in rollup_units]
+tables_ensured = False  # whether refresh() created the rollup tables missing in a database made before them
+
+
+# returns the SQL of the start of the 'unit' ('hour', 'day' or 'month') of 'date', like date_trunc, which SQLite lacks
+def get_bin(unit):
+    if is_local() and get_local()[0] == 'sqlite':
+        return {'hour': "strftime('%Y-%m-%d %H:00:00', date)", 'day': "strftime('%Y-%m-%d 00:00:00', date)",
+                'month': "strftime('%Y-%m-01 00:00:00', date)"}[unit]
+    return "date_trunc('{}', date)".format(unit)
+
+
+# condition on 'column' with parameter 'key_ids' (see get_params)
+def get_key_filter(key_ids, column):
+    return '' if key_ids is None else ' AND {} = ANY(%(key_ids)s)'.format(column)
+
+
+# parameters of the filters: key ids as text (site ids are also passed as ints), 'start' and 'end'
+def get_params(key_ids, start=None, end=None):
+    return {'key_ids': None if key_ids is None else [str(key_id) for key_id in key_ids], 'start': start, 'end': end}
+
+
+# condition on 'date' for the whole 'unit's overlapping [start, end) with parameters 'start' and 'end'
+def get_range_filter(start, end, unit):
+    where = ''
+    if start is not None:
+        where += " AND date >= date_trunc('{}', %(start)s::timestamp)".format(unit)
+    if end is not None:
+        where += " AND date < date_trunc('{0}', %(end)s::timestamp - interval '1 microsecond') + interval '1 {0}'" \
+            .format(unit)
+    return where
+
+
+# recomputes the rollups of 'table' ('production' or 'component_production') for sites/components 'key_ids'
+# (all if None) and the periods overlapping [start, end)
+# interval - minutes between rows, to get max power from max Wh; if None, power_max is NULL in new periods and
+# unchanged in ones that already had it (e.g. from fetcher_csv.store_site_data, which knows the interval)
+# the rollups of the local database are only copied from PostgreSQL by 'python -m db.local sync'
+def refresh(table, key_ids=None, start=None, end=None, interval=None):
+    global tables_ensured
+    if (key_ids is not None and len(key_ids) == 0) or is_local():
+        return
+    if not tables_ensured:
+        ensure_tables(tables)
+        tables_ensured = True
+    key = keys[table]
+    source = table
+    power_max = 'max(value) * 60.0 / {}'.format(interval) if interval else 'NULL::numeric'
+    for suffix, unit in rollup_units.items():
+        if source == table:
+            values = 'sum(value), count(value), ' + power_max
+        else:  # from the finer rollup
+            values = 'sum(value_sum), sum(value_count), max(power_max)'
+        query = ("INSERT INTO {table}_{suffix} ({key}, date, value_sum, value_count, power_max) "
+                 "SELECT {key}, date_trunc('{unit}', date), {values} FROM {source} WHERE TRUE{range}{keys} "
+                 "GROUP BY 1, 2 ON CONFLICT ({key}, date) DO UPDATE SET value_sum = EXCLUDED.value_sum, "
+                 "value_count = EXCLUDED.value_count, "
+                 "power_max = COALESCE(EXCLUDED.power_max, {table}_{suffix}.power_max), updated_on = NOW()"
+                 .format(table=table, suffix=suffix, key=key, unit=unit, values=values, source=source,
+                         range=get_range_filter(start, end, unit), keys=get_key_filter(key_ids, key)))
+        if run_queries([query], params=[get_params(key_ids, start, end)]) is None:
+            raise RuntimeError('Could not refresh {}_{}'.format(table, suffix))
+        source = '{}_{}'.format(table, suffix)
+
+
+# returns the name of the coarsest table with rows of 'resolution' (minutes, or 'month') in [start, end):
+# a rollup whose periods make up the resolution and start and end, or the raw table if there is none
+def choose_rollup(table, start, end, resolution):
+    if resolution == 'month':
+        if start.day == 1 and end.day == 1 and start.time() == time(0) and end.time() == time(0):
+            return table + '_monthly'
+        resolution = 24 * 60  # months from days
+    for suffix in ['daily', 'hourly']:
+        minutes = unit_minutes[rollup_units[suffix]]
+        if resolution % minutes == 0 and all((dt - dt.replace(hour=0, minute=0, second=0, microsecond=0))
+                                             .total_seconds() % (minutes * 60) == 0 for dt in [start, end]):
+            return '{}_{}'.format(table, suffix)
+    return table
+
+
+# returns rows of 'source' (the raw table or one of its rollups) of sites/components 'key_ids' (all if None) in
+# [start, end) with columns key, 'date', 'value_sum', 'value_count', 'power_max'
+def read_rows(table, source, key_ids, start, end, interval=None):
+    key = keys[table]
+    if source == table:
+        values = 'value AS value_sum, CASE WHEN value IS NULL THEN 0 ELSE 1 END AS value_count, {} AS power_max' \
+            .format('value * 60.0 / {}'.format(interval) if interval else 'CAST(NULL AS numeric)')
+    else:
+        values = 'value_sum, value_count, power_max'
+    df = run_query("SELECT {key}, date, {values} FROM {source} WHERE date >= %(start)s AND date < %(end)s{keys} "
+                   "ORDER BY 1, 2".format(key=key, values=values, source=source, keys=get_key_filter(key_ids, key)),
+                   True, params=get_params(key_ids, start, end))
+    if df is None:
+        raise RuntimeError('Could not read ' + source)
+    df['power_max'] = df['power_max'].astype(float)
+    return df
+
+
+# returns (rows, whether raw rows were added): the rollup rows 'df' of 'source' with the periods it doesn't cover
+# read from the raw table instead:
+# periods whose number of raw rows is not the rollup's value_count, e.g. production stored before the rollups,
+# by the local database or by anything else that didn't refresh them (or rows with NULL values, which are exact
+# either way); only the raw rows of those periods are read
+def add_uncovered(table, source, df, key_ids, start, end, interval=None):
+    key = keys[table]
+    unit = rollup_units[source[len(table) + 1:]]
+    counts = run_query("SELECT {key}, {bin} AS date, count(*) AS n_rows FROM {table} WHERE date >= %(start)s "
+                       "AND date < %(end)s{keys} GROUP BY 1, 2".format(key=key, bin=get_bin(unit), table=table,
+                                                                        keys=get_key_filter(key_ids, key)),
+                       True, params=get_params(key_ids, start, end))
+    if counts is None:
+        raise RuntimeError('Could not count rows of ' + table)
+    counts = counts.astype({key: str}).merge(df[[key, 'date', 'value_count']].astype({key: str}),
+                                             on=[key, 'date'], how='outer')
+    uncovered = counts[counts['n_rows'] != counts['value_count']]  # NaN on either side if only one has the period
+    if uncovered.empty:
+        return df, False
+    print('{} of {} periods not in {}, reading {}'.format(len(uncovered), len(counts), source, table))
+    periods = set(zip(uncovered[key], uncovered['date']))
+    df = df[[period not in periods for period in zip(df[key].astype(str), df['date'])]]
+    stale = uncovered['n_rows'].isna()  # rollup periods without raw rows anymore
+    if stale.all():
+        return df, False
+    uncovered = uncovered[~stale]
+    raw = read_rows(table, table, list(uncovered[key].unique()), uncovered['date'].min(),
+                    uncovered['date'].max() + pd.DateOffset(**{unit + 's': 1}), interval)
+    bins = raw['date'].dt.to_period('M').dt.to_timestamp() if unit == 'month' else raw['date'].dt.floor(unit_freq[unit])
+    raw = raw[[period in periods for period in zip(raw[key].astype(str), bins)]]
+    return (raw if df.empty else pd.concat([df, raw], ignore_index=True)), True
+
+
+# returns production of sites/components 'key_ids' (all if None) in [start, end) per 'resolution' (minutes, or
+# 'month') from the coarsest table that has it (see choose_rollup): columns key, 'date', 'value_sum' (Wh),
+# 'value_count' (rows), 'power_max' (W, needs 'interval' of the raw rows if read from the raw table)
+# periods the rollup doesn't cover, and everything if the database has no such rollup yet (e.g. a local one or one
+# made before the rollups), are read from the raw table (see add_uncovered); 'python -m db.rollup' fills the rollups
+def get_rollup(table, key_ids, start, end, resolution, interval=None):
+    key = keys[table]
+    source = choose_rollup(table, start, end, resolution)
+    if source != table and source not in get_tables():
+        print('No {}, reading {}'.format(source, table))
+        source = table
+    df = read_rows(table, source, key_ids, start, end, interval)
+    if source != table:
+        df, mixed = add_uncovered(table, source, df, key_ids, start, end, interval)
+        if mixed:  # rows of the raw table are binned below like the whole range was read from it
+            source = table
+    if source != table and unit_minutes.get(rollup_units[source[len(table) + 1:]], 'month') == resolution:
+        return df  # rows are already of the resolution
+    # coarser bins from finer rows, aligned to midnight (like date_trunc)
+    freq = 'MS' if resolution == 'month' else '{}min'.format(resolution)
+    df = df.groupby([key, pd.Grouper(key='date', freq=freq)]).agg({'value_sum': 'sum', 'value_count': 'sum',
+                                                                    'power_max': 'max'})
+    return df.reset_index()
+
+
+# returns the sum of production of sites per day in [start, end) and the number of rows it is averaged over, as
+# analysis.average_daily_efficiency always did: rows of a day are counted from the last one before which the day's
+# running sum is still 0, so the zeros before the sun rises are left out, but not those after it sets; a day with a
+# NULL value has a NULL sum; columns 'site_id', 'date', 'value_sum', 'value_count'
+# computed from the raw table, as the rollups don't keep the order of rows within their periods
+def get_daily_sums(site_ids, start, end):
+    day = get_bin('day')
+    window = 'PARTITION BY site_id, {}'.format(day)
+    df = run_query(
+        "SELECT site_id, day AS date, CASE WHEN max(n_null) > 0 THEN NULL ELSE sum(value) END AS value_sum, "
+        "sum(CASE WHEN date >= counted_from THEN 1 ELSE 0 END) AS value_count FROM ("
+        "SELECT site_id, day, date, value, n_null, max(CASE WHEN before = 0 THEN date END) "
+        "OVER (PARTITION BY site_id, day) AS counted_from FROM ("
+        "SELECT site_id, {day} AS day, date, value, count(*) OVER ({window}) - count(value) OVER ({window}) AS n_null, "
+        "COALESCE(sum(value) OVER ({window} ORDER BY date ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING), 0) "
+        "AS before FROM production WHERE date >= %(start)s AND date < %(end)s{keys}) AS running) AS counted "
+        "GROUP BY 1, 2 ORDER BY 1, 2".format(day=day, window=window, keys=get_key_filter(site_ids, 'site_id')),
+        True, params=get_params(site_ids, start, end))
+    if df is None:
+        raise RuntimeError('Could not read daily sums of production')
+    return df
+
+
+# returns a dataframe of average daily efficiency (mean power / system size) of sites in [start, end):
+# columns 'site_id', 'date' ('2020-01-20'), 'value'
+# interval - minutes between production rows
+def get_daily_efficiency(site_ids, start, end, interval):
+    daily = get_daily_sums(site_ids, start, end)
+    sizes = run_query('SELECT site_id, size FROM site WHERE TRUE' + get_key_filter(site_ids, 'site_id'), True,
+                      params=get_params(site_ids))
+    if sizes is None:
+        raise RuntimeError('Could not read site sizes')
+    daily = daily.merge(sizes, on='site_id')
+    daily['value'] = daily['value_sum'].astype(float) / daily['value_count'] / (interval / 60) \
+        / (daily['size'].astype(float) * 1000)
+    daily['date'] = daily['date'].dt.strftime('%Y-%m-%d')
+    return daily[['site_id', 'date', 'value']]
+
+
+if __name__ == '__main__':
+    for table in keys:
+        refresh(table)
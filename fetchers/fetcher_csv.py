@@ -1,5 +1,7 @@
 import os
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from io import StringIO
 import pytz
@@ -7,22 +9,46 @@ from bs4 import BeautifulSoup
 
 import numpy as np
 import pandas as pd
-import requests
 import sqlalchemy
 from dateutil.relativedelta import relativedelta
-from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import ChunkedEncodingError, RequestException
 
-from db.helper_db import get_db_params, run_query
+from db.helper_db import IteratorFile, copy_merge, get_copy_query, get_db_params, is_local, iter_copy_text, \
+    merge_keys, run_query, store_local, transaction
+from db.registry import Registry
+from db import partitions, rollup
+from fetchers import frame_cache, http_client
 from fetchers.fetcher_xml import get_active_sites
+from fetchers.rate_limiter import RateLimiter
+from fetchers.raw_store import open_store
 
 DIR = 'solectria_raw_csv'
+PARSED_DIR = 'solectria_parsed_csv'
 URL = "https://solrenview.com/cgi-bin/cgihandler.cgi"
 
-wait_time = 2  # seconds
-last_fetch = 0
+wait_time = 2  # seconds before retrying a broken download
+requests_per_second = 4  # average rate of requests to solrenview over all threads (each view takes two)
+max_in_flight = 4  # max number of requests running at the same time
+limiter = RateLimiter(requests_per_second, max_in_flight)
+
+engine = None  # see get_engine()
+engine_pool_size = 4
+
+open_period_ttl = 3600  # seconds a download of a period that is still filling up (e.g. this week) is reused
+upload_delay = timedelta(hours=2)  # time after the end of a period when its data is considered complete
+fetch_id_ttl = timedelta(days=30)  # fetch_ids checked longer ago are probed again by store_sites()
+# fetch_id in the link to the .csv in the html of a view: '/downloads/.../Site4760_QuadSeven(Inverter-...).csv'
+fetch_id_pattern = re.compile(r"/downloads/(?:[^'\"/]*/)*[^'\"/_]*_([^'\"/(]*)\(")
 
 unit_view = {'day': '0', 'week': '1', 'month': '2', '0': 'day', '1': 'week', '2': 'month'}
 interval_unit = {'day': 1, 'week': 10, 'month': 60, 1: 'day', 10: 'week', 60: 'month'}
+unit_length = {'day': relativedelta(days=1), 'week': relativedelta(weeks=1), 'month': relativedelta(months=1)}
+unit_rows_per_day = {'day': 24 * 60, 'week': 24 * 6, 'month': 24}  # rows downloaded per day of a view
+
+# raised when the views of a range have no production, unlike a download or .csv that failed (RuntimeError)
+class NoDataError(RuntimeError):
+    pass
+
 
 sites_data = pd.read_csv('./csv/solectria_sites.csv')
 sites_data['site_id'] = sites_data['site_id'].astype(int)
@@ -49,28 +75,59 @@ get_date_ago = {'day': lambda target, n: round_dt['day'](target) - timedelta(day
                 'month': lambda target, n: round_dt['month'](target) - relativedelta(months=n)}
 
 
-# modifies active_sites_data.csv by adding a column to the solectria_sites available for .csv fetch
-def store_sites(sites):
-    for site in sites:
-        fetch("0,0,1,1", site)
-    # reading all files in DIR
-    files = [f for f in os.listdir(DIR)]
-    sites = [int(f[4:f.find('_')]) for f in files]
-    names = [f[f.find('_') + 1:f.find('(')] for f in files]
-    csv_dict = {k: v for k, v in sorted(dict(zip(sites, names)).items(), key=lambda item: item[0])}
-
-    # reading solectria_sites metadata file
-    df = pd.read_csv('active_sites_data.csv')
-    df.set_index(df.columns[0], inplace=True)
-    df.insert(9, 'fetch_id', '')
-    for site_id in csv_dict:
-        if site_id in df['fetch_id']:
-            df['fetch_id'][site_id] = csv_dict[site_id]
-        else:
-            df = pd.concat([df, pd.DataFrame({'fetch_id': csv_dict[site_id]}, [site_id])])
-    # df.sort_index(inplace=True)
-    # df['fetch_id'] = df['fetch_id']  # idk why it works but without this there's only 300 fetch_ids committed out of 800
-    df.to_csv('active_sites_data.csv')
+# one request to solrenview: takes one token of the limiter, whose slot is only held while downloading
+# returns the body as str if text == True, otherwise as bytes
+def download(url, text=False):
+    with limiter:
+        with http_client.get(url) as r:
+            r.raise_for_status()  # an error page is never taken for the view or its .csv
+            return r.text if text else r.content
+
+
+# returns the fetch_id of a site from the link to the .csv in the html of its view, '' if there is no link,
+# or None if the request failed; the .csv itself is not downloaded
+def probe_fetch_id(site_id, view="0,0,1,1"):
+    url = URL + '?view={view}&cond=site_id={site_id}'.format(view=view, site_id=site_id)
+    try:
+        html = download(url, text=True)
+    except RequestException as e:
+        print(site_id, e)
+        return None
+    match = fetch_id_pattern.search(html)
+    return match.group(1) if match else ''
+
+
+# writes the dataframe of sites to the csv, replacing it only once it is complete
+def write_sites(df, filename):
+    df.to_csv(filename + '.tmp', index_label='site_id')
+    os.replace(filename + '.tmp', filename)
+
+
+# sets 'fetch_id' (and 'fetch_id_checked', when it was found) in active_sites_data.csv for the sites
+# available for .csv fetch, probing 'workers' sites at a time; only sites never checked and without a fetch_id,
+# or checked more than fetch_id_ttl ago, are probed; the csv is saved after every 'batch' sites
+def store_sites(sites, filename='active_sites_data.csv', workers=8, batch=50):
+    df = pd.read_csv(filename, dtype=str, keep_default_na=False, index_col=0)
+    df.index = df.index.astype(int)
+    for column in ['fetch_id', 'fetch_id_checked']:
+        if column not in df:
+            df[column] = ''
+    now = datetime.utcnow()
+    checked = pd.to_datetime(df['fetch_id_checked'], errors='coerce')
+    stale = ((checked.isna() & (df['fetch_id'] == '')) | (checked < now - fetch_id_ttl))
+    sites = [site for site in sites if site not in df.index or stale[site]]
+    print('Probing fetch_id of {} sites'.format(len(sites)))
+
+    with ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(probe_fetch_id, site): site for site in sites}
+        for i, future in enumerate(as_completed(futures), 1):
+            fetch_id = future.result()
+            if fetch_id is None:  # probed again next time
+                continue
+            df.loc[futures[future], ['fetch_id', 'fetch_id_checked']] = [fetch_id, now.isoformat(timespec='seconds')]
+            if i % batch == 0:
+                write_sites(df.fillna(''), filename)
+    write_sites(df.fillna(''), filename)
 
 
 # splits inverter name into its order, serial number, and model
@@ -88,17 +145,34 @@ def split_inv_name(inv_name):
     return order, manuf_id, model
 
 
-# returns name of a .csv file given site_id and period
-# site_id - int, view - str (e.g.: "0,1,0,0"), dt - datetime obj of the beginning of intended period
-def get_file_name(site_id, view, dt):
+# returns the unit and the first day of the period fetched by a view, e.g.: ('week', date(2020, 2, 24))
+# view - str (e.g.: "0,1,0,0"), dt - current datetime at the site's timezone
+def get_period(view, dt):
     views = view.split(',')
     unit = unit_view[views[1]]
-    if unit != 'month':
-        of = str(get_date_ago[unit](dt, int(views[2])).date())
-    else:
-        of = get_date_ago[unit](dt, int(views[2])).date().strftime("%B %Y")
-    return "Site" + str(site_id) + "_" + sites_data['fetch_id'][site_id] + '(Inverter-Direct,' + \
-           unit.capitalize() + ' of ' + of + ').csv'
+    return unit, get_date_ago[unit](dt, int(views[2])).date()
+
+
+# returns (site_id, unit, period) from a .csv file name of the server, or None if it is not one, e.g.:
+# 'Site4760_QuadSeven(Inverter-Direct,Week of 2020-02-24).csv' -> ('4760', 'week', '2020-02-24')
+# 'Site4760_QuadSeven(Inverter-Direct,Month of February 2020).csv' -> ('4760', 'month', '2020-02-01')
+def get_key_from_file_name(name):
+    try:
+        site_id = int(name[4:name.index('_')])
+        unit, of = name[name.rindex(',') + 1:name.rindex(')')].split(' of ')
+        unit = unit.lower()
+        if unit == 'month':
+            of = datetime.strptime(of, "%B %Y").date()
+        else:
+            of = datetime.strptime(of, "%Y-%m-%d").date()
+    except ValueError:
+        return None
+    return str(site_id), unit, str(of)
+
+
+# changes the shared limit of requests to solrenview, e.g. set_rate_limit(4, 8) for 4 requests/s with 8 at a time
+def set_rate_limit(rate, in_flight=None):
+    limiter.configure(rate, in_flight)
 
 
 # returns end datetime in given timezone
@@ -109,107 +183,117 @@ def get_timezone_time(site_id):
         return datetime.now()
 
 
-# view - string of arguments
-def fetch(view, site_id):
+# returns unix time of a datetime at the site's timezone
+def get_timestamp(site_id, dt):
     try:
-        filename = DIR + "/" + get_file_name(site_id, view, get_timezone_time(site_id))
-    except (KeyError, TypeError):
-        filename = "filename unknown"
-    # print("Fetching file:", filename)
-    if not os.path.exists(DIR):
-        os.makedirs(DIR)
-    if not os.path.exists(filename):
-        global last_fetch
-        while time.time() - last_fetch < wait_time:
-            time.sleep(0.1)
-        last_fetch = time.time()
+        return pytz.timezone(sites_data['timezone'][site_id]).localize(dt).timestamp()
+    except KeyError:
+        return dt.timestamp()
+
+
+# whether a stored download can be used instead of fetching it again:
+# periods that were over when downloaded (plus upload_delay) never change; open ones are reused for open_period_ttl
+def is_fresh(site_id, unit, period, entry):
+    if time.time() - entry.fetched_at < open_period_ttl:
+        return True
+    period_end = datetime.combine(period, datetime.min.time()) + unit_length[unit] + upload_delay
+    return get_timestamp(site_id, period_end) <= entry.fetched_at
+
 
+# returns the store key (site_id, unit, period) of a view and its stored Entry if it is fresh, otherwise None
+def get_stored(view, site_id):
+    key = (site_id,) + get_period(view, get_timezone_time(site_id))
+    entry = open_store(DIR).lookup(*key)
+    return key, entry if entry is not None and is_fresh(*key, entry) else None
+
+
+# view - string of arguments
+# returns raw .csv, from the store if it was already downloaded and is not outdated
+def fetch(view, site_id):
+    raw_store = open_store(DIR)
+    (_, unit, period), entry = get_stored(view, site_id)
+    raw = None if entry is None else raw_store.read(entry)
+    if raw is None:
         url = URL + '?view={view}&cond=site_id={site_id}'.format(view=view, site_id=site_id)
         try:
-            with requests.get(url) as r:
-                s = r.content
-                r.close()
-            try:
+            s = download(url)
+            try:  # parsed outside of the limiter, so other threads can use the slot meanwhile
                 s = BeautifulSoup(s, "html.parser").find_all('script')[-2].text
                 new_url = "https://solrenview.com" + s[s.index('/downloads'):s.index('.csv') + 4]
             except:
                 return ""
-
-            filename = DIR + '/' + new_url.split('/')[-1]  # .csv file
-
-            with requests.get(new_url) as r:
-                raw = r.text
-                r.close()
+            raw = download(new_url, text=True)
+            if 'Timeframe' not in raw:  # e.g. a throttling page, not stored so the next attempt downloads it again
+                raise RuntimeError('Not a .csv: ' + raw[:200] + '...')
 
         except ChunkedEncodingError as e:
             print(e)
             time.sleep(wait_time)
             return fetch(view, site_id)  # might not be the best solution but idk how else to fix it
 
-        with open(filename, 'w+') as f:
-            f.write(raw)
-    else:
-        with open(filename, 'r') as f:
-            raw = f.read()
+        replaced = raw_store.lookup(site_id, unit, period)
+        digest = raw_store.put(site_id, unit, period, raw, name=new_url.split('/')[-1]).digest  # name of the .csv
+        if replaced is not None and replaced.digest != digest:  # frames of the old download are never read again
+            frame_cache.remove(PARSED_DIR, replaced.digest)
     return raw
 
 
-# raw - str of .csv
-# returns a tuple of lists: ['inverter_name1', ...], [<dataframe>, ...]
+# raw - str of .csv, e.g.:
+#   Quad 7 - Phase 2 ...
+#   ,inv#1  - 1013021546296  (PVI 28TL),,,inv#2  - ...,,,Weather (...)
+#   Timeframe,AC Energy,AC Power,AC Current,AC Energy,...
+#   ,kWh,W,A,kWh,...
+#   [2020-02-23 00:00:00],12.5,1503,2.1,(null,null,null),...
+# returns a list of dataframes, one per inverter (and weather station, if any) with the name in columns.name,
+# indexed by the timeframe as a DatetimeIndex; missing values are 0
 def parse(raw):
     try:
-        raw = raw[raw.index('inv') - 1:]  # remove the header ("Quad 7 - Phase 2...")
+        names_start = raw.index('inv') - 1  # skipping the header ("Quad 7 - Phase 2...")
+        header_start = raw.index('Timeframe', names_start)
     except ValueError:
-        raise RuntimeError('Impossible to parse: ' + raw + "...")
-    i = raw.index('Timeframe')
-    raw = raw[:i] + raw[i:].replace('(', '').replace(')', '')  # turning '(null' and 'null)' into 'null'
-
-    # list ['', 'inv#1  - 1013021546296  (PVI 28TL)', '', '', '', '', '', ...]
-    inverters_raw = raw[:raw.index('Timeframe')].strip().split(',')
-
-    if 'Weather' in inverters_raw[-1]:
-        j = raw.index('Weather')
-        i = raw[j:].index(')')  # last character on line with inverters
-        raw = raw[:i + j + 1] + ',,,,' + raw[i + j + 1:]  # adding comas to end of Weather, otherwise it skews the table
-    # indexes of inverters to split vertically; - 1 because timeframe is removed later
-    indexes = [i - 1 for i in range(len(inverters_raw)) if inverters_raw[i] != '' and i != 1]
-
-    csv = pd.read_csv(StringIO(raw))
-    # setting timeframe as a id (instead of 0, 1, ...) and removing brackets: e.g.: '[2019-...:00]' -> '2019-...:00'
-    csv.set_index(csv.columns[0], inplace=True)
-
-    # dfs = np.split(csv, indexes, axis=1)  # ineffective, takes about 0.4s
-
-    indexes.append(len(csv.columns))
-    dfs = [] * len(indexes)
-    prev_i = 0
-    for i in indexes:
-        dfs.append(csv[csv.columns[prev_i:i]])
-        prev_i = i
-
-    del csv, raw
-
-    dfs_fin = [] * len(dfs)
-    for i in range(len(dfs)):
-        rows = np.split(dfs[i], [1, 2])  # splitting into columns (0), units (1) - unused, rest of data (2)
-        main_df = rows[2]
-        main_df.columns = list(rows[0].iloc[0])  # setting column names [AC Energy, AC Power, ...]
-        main_df.index = list(map(lambda x: x[1:-1], rows[2].index))  # '[2020-02-23 00:00:00]' -> '2020-02-23 00:00:00'
-        main_df.fillna(0, inplace=True)
-        if 'inv' in rows[0].columns[0]:
-            main_df["AC Power"] = main_df["AC Power"].astype(int)
-            main_df["AC Energy"] = main_df["AC Energy"].astype(float)
-            try:
-                main_df["AC Current"] = main_df["AC Current"].astype(float)
-            except KeyError:  # "AC Current" not in df
-                pass
-        elif 'Weather' in rows[0].columns[0]:
-            for col in main_df.columns:
-                main_df[col] = main_df[col].astype(float)
-        main_df.columns.name = rows[0].columns[0]  # setting inverter's name
-        dfs_fin.append(main_df)
-
-    return dfs_fin
+        raise RuntimeError('Impossible to parse: ' + raw[:200] + "...")
+    units_start = raw.find('\n', header_start) + 1
+    data_start = raw.find('\n', units_start) + 1
+
+    # ['', 'inv#1  - 1013021546296  (PVI 28TL)', '', '', 'inv#2  - ...', ...]; a block starts at each non-empty name
+    names = raw[names_start:header_start].strip().split(',')
+    # ['Timeframe', 'AC Energy', 'AC Power', ...]; the weather's name row is shorter, so width is taken from here
+    columns = raw[header_start:units_start].strip().replace('(', '').replace(')', '').split(',')
+    starts = [i for i in range(1, len(names)) if names[i] != '']
+    bounds = list(zip(starts, starts[1:] + [len(columns)]))
+
+    if units_start == 0 or data_start in (0, len(raw)):  # no rows
+        data = pd.DataFrame(columns=range(1, len(columns)), index=pd.DatetimeIndex([]), dtype=float)
+    else:
+        buffer = StringIO(raw)
+        buffer.seek(data_start)
+        # '(null' and 'null)' are the bounds of an inverter without data
+        data = pd.read_csv(buffer, header=None, names=range(len(columns)), index_col=0,
+                           na_values=['null', '(null', 'null)', '(null)'], engine='c')
+        data.index = pd.to_datetime(data.index, format='[%Y-%m-%d %H:%M:%S]').rename(None)
+        for col in data.columns[data.dtypes == object]:  # only if a value itself is in brackets, e.g.: '(12.5'
+            data[col] = pd.to_numeric(data[col].str.strip('()'), errors='coerce')
+    values = data.to_numpy(dtype=float)
+    values[np.isnan(values)] = 0
+
+    dfs = []
+    for start, end in bounds:
+        df = pd.DataFrame(values[:, start - 1:end - 1], index=data.index, columns=columns[start:end])
+        if 'inv' in names[start] and 'AC Power' in df:
+            df['AC Power'] = df['AC Power'].astype(int)
+        df.columns.name = names[start]
+        dfs.append(df)
+    return dfs
+
+
+# one engine for the process, its connections are pooled and reused by all store() calls
+def get_engine():
+    global engine
+    if engine is None:
+        engine = sqlalchemy.create_engine(
+            "postgresql://{user}:{password}@{host}:5432/{database}".format(**get_db_params()),
+            pool_size=engine_pool_size, max_overflow=engine_pool_size, pool_pre_ping=True)
+    return engine
 
 
 # inserts dataframe (df) into the database (from db_params) into given table
@@ -217,52 +301,138 @@ def parse(raw):
 # e.g.: {'site_id': 4760} to will add a column 'site_id' and puts 4760 in all rows
 # rename - specified which columns should be renamed before putting into a database
 # e.g.: {"AC Power": "value"} - replaces dataframe's column 'AC Power' with databases's 'value'
+# drop - columns that are not inserted
+# bulk_load - streams the dataframe to COPY in chunks of db.helper_db.copy_chunksize rows, df itself is not copied;
+# rows of tables with a key in db.helper_db.merge_keys are merged by it (see copy_merge), so storing again is safe
 def store(table, df, defaults={}, rename={}, drop=[], index_label=None, bulk_load=False):
-    conn = None
-    raw_conn = None
-    try:
-        engine = sqlalchemy.create_engine(
-            "postgresql://{user}:{password}@{host}:5432/{database}".format(**get_db_params()))
-        conn = engine.connect()
-        df = df.copy()
-        if len(rename) != 0:
-            df.rename(columns=rename, inplace=True)
-        if len(drop) != 0:
-            df.drop(drop, axis=1, inplace=True)
-        for item in defaults.items():
-            df.insert(0, item[0], item[1])
-        if bulk_load:
-            output = StringIO()
-            df.to_csv(output, sep='\t', header=False)
-            output.getvalue()
-            output.seek(0)  # jump to start of stream
-            raw_conn = engine.raw_connection()
-            cursor = raw_conn.cursor()
-            columns = [index_label] + list(df.columns) if index_label else df.columns
-            cursor.copy_from(output, table, null="", columns=columns)
-            raw_conn.commit()
-            cursor.close()
-            raw_conn.close()
-        else:
+    columns = [c for c in df.columns if c not in drop and rename.get(c, c) not in drop]
+    names = ([index_label] if index_label else []) + list(defaults) + [rename.get(c, c) for c in columns]
+    if is_local():  # the local database of db.helper_db, merged by the same keys
+        df = df[columns].rename(columns=rename)
+        for name, value in reversed(list(defaults.items())):
+            df.insert(0, name, value)
+        store_local(table, df.rename_axis(index_label).reset_index() if index_label else df, merge_keys.get(table))
+    elif bulk_load and table in merge_keys:  # stored rows are updated instead of duplicated
+        copy_merge(table, iter_copy_text(df, columns, defaults, index_label is not None), names, merge_keys[table])
+    elif bulk_load:
+        with transaction() as cursor:  # connection from the pool of db.helper_db
+            cursor.copy_expert(get_copy_query(table, names),
+                               IteratorFile(iter_copy_text(df, columns, defaults, index_label is not None)), size=65536)
+    else:
+        df = df[columns].rename(columns=rename)
+        for name, value in reversed(list(defaults.items())):
+            df.insert(0, name, value)
+        with get_engine().begin() as conn:
             df.to_sql(table, conn, if_exists='append', index=False if index_label is None else True,
                       index_label=index_label)
-    finally:
-        if conn is not None:
-            conn.close()
-        if raw_conn is not None:
-            raw_conn.close()
 
 
 # returns dataframes of inverter production production
+# parsed frames are cached by the hash of the stored .csv, so stored views are never parsed twice
 def get_inv_production(site_id, view):
-    return parse(fetch(view, site_id))
+    key, entry = get_stored(view, site_id)
+    if entry is not None:
+        dfs = frame_cache.load(PARSED_DIR, entry.digest)
+        if dfs is not None:
+            return dfs
+    dfs = parse(fetch(view, site_id))
+    entry = open_store(DIR).lookup(*key)
+    if entry is not None:
+        frame_cache.save(PARSED_DIR, entry.digest, dfs)
+    return dfs
 
 
 # returns dataframe of site production combined from its inverters
 # start, end - datetime objects
 # interval - time interval for production batches in minutes, can be 1, 10, or 60
-def get_site_production(site_id, start, end, time_interval=10):
-    return merge_inv_production(get_historical_data(site_id, start, end, interval_unit[time_interval]))
+# (or any multiple of 1 with plan=True, which fetches the fewest views with get_planned_data)
+def get_site_production(site_id, start, end, time_interval=10, workers=1, plan=False):
+    if plan:
+        return merge_inv_production(get_planned_data(site_id, start, end, time_interval, workers))
+    return merge_inv_production(get_historical_data(site_id, start, end, interval_unit[time_interval], workers))
+
+
+# returns the fewest views (and, among those, with the fewest rows) covering [start, end) at 'resolution' minutes:
+# [(unit, period start, cover start, cover end), ...], each view used for [cover start, cover end) of its period
+# only views whose native interval (day: 1, week: 10, month: 60 minutes) divides 'resolution' are used, e.g.:
+# 3 Mar - 28 Apr at 60 -> months; 30 Mar - 6 Apr at 60 -> the week of 30 Mar instead of March and April
+def plan_views(start, end, resolution):
+    units = [unit for unit in ('month', 'week', 'day') if resolution % interval_unit[unit] == 0]
+    if len(units) == 0:
+        raise ValueError('No view gives {}-minute production'.format(resolution))
+    first = round_dt['day'](start)
+    n_days = (round_dt['day'](end - timedelta(minutes=1)) - first).days + 1
+    # best[i] - (requests, rows, unit, next day) covering days i, ..., n_days - 1
+    best = [(0, 0, None, n_days)] * (n_days + 1)
+    for i in range(n_days - 1, -1, -1):
+        day = first + timedelta(days=i)
+        options = []
+        for unit in units:
+            period_start = round_dt[unit](day)
+            period_end = period_start + unit_length[unit]
+            j = min(n_days, (period_end - first).days)
+            options.append((best[j][0] + 1, best[j][1] + (period_end - period_start).days * unit_rows_per_day[unit],
+                            unit, j))
+        best[i] = min(options, key=lambda option: option[:2])
+
+    plan = []
+    i = 0
+    while i < n_days:
+        unit, j = best[i][2:]
+        day = first + timedelta(days=i)
+        plan.append((unit, round_dt[unit](day), max(start, day), min(end, first + timedelta(days=j))))
+        i = j
+    return plan
+
+
+# prints and returns the number of requests of the plan for [start, end) at 'resolution' vs get_historical_data
+# with the coarsest unit that gives 'resolution' (e.g. months for daily production)
+def compare_plan(start, end, resolution):
+    unit = next(unit for unit in ('month', 'week', 'day') if resolution % interval_unit[unit] == 0)
+    current = get_units_ago[unit](start, end - timedelta(minutes=1)) + 1
+    planned = len(plan_views(start, end, resolution))
+    print('{} - {} at {} minutes: {} requests instead of {} ({} saved)'.format(start, end, resolution, planned,
+                                                                               current, current - planned))
+    return planned, current
+
+
+# same as get_historical_data, but fetches the views from plan_views() and resamples them to 'resolution' minutes
+# values are averaged over each interval, 'AC Power' is then converted to Wh of the interval
+def get_planned_data(site_id, start, end, resolution, workers=1):
+    current = get_timezone_time(site_id)
+    plan = plan_views(start, end, resolution)
+    views = ["0,{},{},1".format(unit_view[unit], get_units_ago[unit](period_start, current))
+             for unit, period_start, _, _ in plan]
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            periods = list(pool.map(lambda view: get_inv_production(site_id, view), views))
+    else:
+        periods = (get_inv_production(site_id, view) for view in views)
+
+    total = combine_periods([resample(df[(df.index >= cover_start) & (df.index < cover_end)], resolution)
+                             for df in data] for (_, _, cover_start, cover_end), data in zip(plan, periods)
+                            if not is_empty_period(data))
+    if total is None:
+        raise NoDataError('Fetched data is empty')
+    return total
+
+
+# returns dt floored to the start of its 'minutes'-long interval, counted from the epoch like the intervals of
+# resample() (so from midnight if they divide a day)
+def floor_interval(dt, minutes):
+    step = timedelta(minutes=minutes)
+    return datetime(1970, 1, 1) + (dt - datetime(1970, 1, 1)) // step * step
+
+
+# averages a frame over 'resolution'-minute intervals; 'AC Power' in W becomes Wh of each interval
+# intervals start at multiples of 'resolution' from the epoch, so they are the same for every view
+def resample(df, resolution):
+    name = df.columns.name
+    df = df.resample('{}min'.format(resolution), origin='epoch').mean().fillna(0)
+    if 'AC Power' in df:
+        df['AC Power'] = (df['AC Power'] * resolution / 60).round().astype(int)
+    df.columns.name = name
+    return df
 
 
 # returns a dataframe of 10-minute production batches [start, end)
@@ -270,38 +440,63 @@ def get_site_production(site_id, start, end, time_interval=10):
 # end - end datetime at the timezone
 # time_unit - 'day', 'week', or 'month' in which data will be fetched
 # 'day': 1-minute intervals, 'week': 10-minute intervals, 'month': 1-hour intervals
-def get_historical_data(site_id, start, end, time_unit='week'):
+# workers - number of views fetched in parallel (all of them still go through the shared limiter)
+def get_historical_data(site_id, start, end, time_unit='week', workers=1):
+    views = get_views(site_id, start, end, time_unit)
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:  # map() keeps the order of views
+            periods = list(pool.map(lambda view: get_inv_production(site_id, view), views))
+    else:
+        periods = (get_inv_production(site_id, view) for view in views)
+
+    total = combine_periods(data for data in periods if not is_empty_period(data))
+    if total is None:
+        raise NoDataError('Fetched data is empty')
+    return trim_production(total, start, end)
+
+
+# concatenates frames of periods [[inv1, inv2, ...], [inv1, inv2, ...], ...] into [inv1, inv2, ...]
+# with one pd.concat per frame (concatenating period by period would copy everything gathered so far every time)
+# returns None if there are no periods
+def combine_periods(periods):
+    parts = None
+    for data in periods:
+        if parts is None:
+            parts = [[] for _ in data]
+        for j in range(len(parts)):
+            parts[j].append(data[j])
+    if parts is None:
+        return None
+    return [frames[0] if len(frames) == 1 else pd.concat(frames) for frames in parts]
+
+
+# returns views to fetch [start, end) in time_unit, from the oldest to the latest, e.g.: ['0,1,3,1', '0,1,2,1', ...]
+def get_views(site_id, start, end, time_unit):
     current = get_timezone_time(site_id)
-    total = None
-    for i in range(get_units_ago[time_unit](start, current),  # iterating through view 'ago' values
-                   get_units_ago[time_unit](end - timedelta(minutes=1), current) - 1, -1):
-        data = get_inv_production(site_id, "0,{},{},1".format(unit_view[time_unit], i))
+    return ["0,{},{},1".format(unit_view[time_unit], i)  # iterating through view 'ago' values
+            for i in range(get_units_ago[time_unit](start, current),
+                           get_units_ago[time_unit](end - timedelta(minutes=1), current) - 1, -1)]
 
-        if False not in [data[j][data[j].columns[0]].isnull().all() for j in range(len(data))]:  # if all values are nan
-            continue
 
-        if not total:  # if first append
-            total = data
-            continue
-        for j in range(len(total)):
-            total[j] = pd.concat([total[j], data[j]])
+# whether all frames of a fetched period are empty
+def is_empty_period(data):
+    return all(pd.isna(df.iloc[:, 0].to_numpy()).all() for df in data)  # if all values are nan
 
-    if total is None:
-        raise RuntimeError('Fetched data is empty')
 
-    for i in range(len(total)):  # removing rows outside of [start, end), e.g.: [mon, tue, |start, ... |, end, sat, sun]
-        total[i] = total[i][np.logical_and(str(start) <= total[i].index, total[i].index < str(end))]
+# converts power to Wh and removes rows outside of [start, end), e.g.: [mon, tue, |start, ... |, end, sat, sun]
+# (converting first, while there are still at least two rows to get the interval from)
+def trim_production(total, start, end):
+    for i in range(len(total)):
         if 'AC Power' in total[i]:
             total[i] = power_to_production(total[i], 'AC Power')
+        total[i] = total[i][(total[i].index >= start) & (total[i].index < end)]
     return total
 
 
 # converts a dataframe column of power in W to production in Wh
 def power_to_production(power, column):
     # time interval in seconds for conversion to watts; based on id[1] - id[0]
-    interval = sum((np.array(list(map(int, power.index[1].split(' ')[1].split(':'))))
-                    - np.array(list(map(int, power.index[0].split(' ')[1].split(':')))))
-                   * np.array([3600, 60, 1]))
+    interval = (power.index[1] - power.index[0]).total_seconds()
     power[column] = power[column].mul(int(round(interval / 3600)))
     return power
 
@@ -317,41 +512,84 @@ def merge_inv_production(inv_dfs):
     return pd.DataFrame(total)
 
 
+# returns the date of the latest production of a site in [start, end) in the database, or None if there is none
+# (production of later periods doesn't mean an earlier one is stored)
+def get_watermark(site_id, start, end):
+    result = run_query('SELECT max(date) AS date FROM production WHERE site_id = %(site_id)s '
+                       'AND date >= %(start)s AND date < %(end)s',
+                       params={'site_id': str(site_id), 'start': start, 'end': end})
+    return None if not result else result[0]['date']
+
+
+# returns [start, end) narrowed down to the production that is not in the database yet and is already complete
+# the last period is still filling up: its rows after the current time, and those of the last upload_delay that
+# are not uploaded yet, are empty (stored as 0), so 'end' is cut at the start of the interval upload_delay ago
+# and the rest is fetched again on the next run
+# both ends are whole intervals (see floor_interval), so a resampled interval is never stored from part of its rows
+def get_missing_range(site_id, start, end, interval):
+    watermark = get_watermark(site_id, start, end)
+    if watermark is not None:
+        start = max(start, watermark + timedelta(minutes=interval))
+    start = floor_interval(start - timedelta(microseconds=1), interval) + timedelta(minutes=interval)  # ceiling
+    now = get_timezone_time(site_id).replace(tzinfo=None) - upload_delay
+    return start, min(end, floor_interval(now, interval))
+
+
 # collects all data about a site for specified time period, including: nn production, component production, & weather
 # inserts all the data into the database
 # start, end - datetime objects
-# interval - time interval for production batches in minutes, can be 1, 10, or 60
-def collect_data(site_id, start, end, interval=10):
+# interval - time interval for production batches in minutes, can be 1, 10, or 60 (or any multiple of 1 with plan)
+# incremental - only fetches production after the latest one of [start, end) in the database (e.g. for nightly
+# refreshes)
+# plan - fetches the fewest views with get_planned_data instead of views of one unit
+# registry - db.registry.Registry shared by an ingest run, which flushes new components and sites itself;
+# if None, a new one is made and flushed at the end
+# returns False if the site has no production in the range; a failed download or parse is raised, to be retried
+def collect_data(site_id, start, end, interval=10, workers=1, incremental=False, registry=None, plan=False):
+    flush = registry is None
+    if flush:
+        registry = Registry()
+    if incremental:
+        start, end = get_missing_range(site_id, start, end, interval)
+        if start >= end:  # nothing new
+            return True
     t = time.time()
     try:
-        inv_data = get_historical_data(site_id, start, end, interval_unit[interval])
-    except RuntimeError:
+        if plan:
+            inv_data = get_planned_data(site_id, start, end, interval, workers)
+        else:
+            inv_data = get_historical_data(site_id, start, end, interval_unit[interval], workers)
+    except NoDataError:
         return False
     print('Time fetching & parsing:', time.time() - t)
     t = time.time()
+    store_site_data(site_id, inv_data, registry)
+    if flush:
+        registry.flush()
+    print('Time inserting into the database:', time.time() - t)
+    return True
+
+
+# inserts production of a site's inverters into the database, including weather if it is the last frame
+# inv_data - frames returned by get_historical_data(), registry - db.registry.Registry for new components and sites
+def store_site_data(site_id, inv_data, registry):
+    if len(inv_data[0]) > 0:  # monthly partitions of the tables for the stored range
+        start, end = inv_data[0].index.min(), inv_data[0].index.max() + timedelta(seconds=1)
+        for table in partitions.partitioned_tables:
+            partitions.ensure_partitions(table, start, end)
     if 'Weather' in inv_data[-1].columns.name:
         store('weather', inv_data[-1], {'site_id': site_id},
               {"Ambient": "temperature_ambient", "Module": "temperature_module", "Irradiance": "irradiance",
                "Wind Direction": "wind_direction", 'Wind Speed': 'wind_speed'}, index_label='date', bulk_load=True)
         inv_data = inv_data[:-1]  # removing weather from inverters
 
-    total = None
     for i in range(len(inv_data)):
         order, manuf_id, model = split_inv_name(inv_data[i].columns.name)
-
-        # check if component already in component_details; throws exception if error with the query
-        if len(run_query(
-                "SELECT * from component_details WHERE manufacturers_component_id LIKE '{}'".format(manuf_id))) == 0:
-            store('component_details', pd.DataFrame(
-                {'component_id': order - 1, 'manufacturers_component_id': manuf_id, 'type': 'inverter',
-                 'sub_type': model, 'site_id': site_id, 'data_provider': 'Solectria', 'manufacturer': 'Solectria',
-                 'is_energy_producing': True}, [0]), index_label=None)
-
+        registry.add_component({'component_id': order - 1, 'manufacturers_component_id': manuf_id, 'type': 'inverter',
+                                'sub_type': model, 'site_id': site_id, 'data_provider': 'Solectria',
+                                'manufacturer': 'Solectria', 'is_energy_producing': True})
         inv_data[i].insert(0, 'component_id', manuf_id)
-        if i == 0:
-            total = inv_data[i]
-            continue
-        total = pd.concat([total, inv_data[i]])
+    total = pd.concat(inv_data)  # all inverters at once
 
     # TODO: check if inverter data is not empty
     store("component_production", total, {'unit': 'Wh'}, {"AC Power": "value"},
@@ -362,9 +600,15 @@ def collect_data(site_id, start, end, interval=10):
     store("production", total_data, {'site_id': site_id, 'unit': 'Wh', 'measured_by': 'INVERTER'},
           {"AC Power": "value"}, [c for c in total_data.columns if c not in ['AC Power']],
           index_label='date', bulk_load=True)
+    if len(total_data) > 0:  # hourly, daily and monthly sums of the periods just stored
+        start, end = total_data.index.min(), total_data.index.max() + timedelta(seconds=1)
+        interval = (total_data.index[1] - total_data.index[0]).total_seconds() / 60 if len(total_data) > 1 else None
+        rollup.refresh('production', [site_id], start, end, interval)
+        rollup.refresh('component_production', list(total['component_id'].unique()), start, end, interval)
 
-    if len(run_query("SELECT * from site WHERE site_id LIKE '{}'".format(site_id))) == 0:
+    if not registry.has_site(site_id):
         site_data = sites_data.loc[site_id].to_dict()
+        site_data['site_id'] = site_id
         site_data['status'] = 'Active'
         try:
             site_data['zip'] = int(site_data['zip'])
@@ -372,6 +616,4 @@ def collect_data(site_id, start, end, interval=10):
                 site_data['zip'] = '0' + str(site_data['zip'])
         except ValueError:
             pass
-        store('site', pd.DataFrame(site_data, [site_id]), index_label='site_id')
-    print('Time inserting into the database:', time.time() - t)
-    return True
+        registry.add_site(site_data)
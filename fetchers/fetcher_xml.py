@@ -1,14 +1,28 @@
+import csv
 import os
 import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fetchers import http_client
+from fetchers.rate_limiter import RateLimiter
+from fetchers.raw_store import open_store
 from misc.helper import plot_days, time_batches
 import requests
+import numpy as np
 import pandas as pd
 
 DIR = 'solectria_raw_xml'
 URL = "http://solrenview.com/xmlfeed/ss-xmlN.php"
-wait_time = 0  # seconds
-last_fetch = 0
+requests_per_second = 10
+max_in_flight = 8
+limiter = RateLimiter(requests_per_second, max_in_flight)  # shared by all threads fetching xml
+max_attempts = 5  # of fetching a site whose connection breaks
+backoff = 6  # seconds before retrying a site, doubled with every attempt
+# the feed returns one total per requested window (ts_start - ts_end), so the window is the resolution of production
+max_window = {'days': 1}  # largest window requested when no resolution is given
+# Wh produced in the window, summed over all elements with the tag (e.g. one per inverter); not yet checked against
+# a recorded response of the feed, see misc/check_xml.py
+production_tag = 'WHr'
 metadata_tags = ['name', 'activationDate', 'latitude', 'longitude', 'line1', 'city', 'state', 'postal', 'timezone']
 
 
@@ -19,35 +33,39 @@ def get_params(site_id, start, end):
         return {'site_id': str(site_id)}
 
 
-def get_filename(params):
-    return DIR + "/" + "_".join(params.values()).replace(':', '=') + '.xml'
+# returns the period of the stored xml, e.g. '2020-01-01T00:00:00_2020-01-01T01:00:00', or 'metadata' if no dates
+def get_period(params):
+    return params['ts_start'] + '_' + params['ts_end'] if 'ts_start' in params else 'metadata'
+
+
+# returns (site_id, 'xml', period) from an old raw file name, e.g.:
+# '4760_2020-01-01T00=00=00_2020-01-01T01=00=00.xml' -> ('4760', 'xml', '2020-01-01T00:00:00_2020-01-01T01:00:00')
+# '4760.xml' -> ('4760', 'xml', 'metadata')
+def get_key_from_file_name(name):
+    if not name.endswith('.xml'):
+        return None
+    values = name[:-len('.xml')].replace('=', ':').split('_', 1)
+    return values[0], 'xml', values[1] if len(values) > 1 else 'metadata'
+
+
+# rate - requests per second, in_flight - requests at the same time (unchanged if None)
+def set_rate_limit(rate, in_flight=None):
+    limiter.configure(rate, in_flight)
 
 
 # start & end - datetime objects
 def fetch(site_id, start, end):
     params = get_params(site_id, start, end)
-    filename = get_filename(params)
-    print("Fetching: " + filename)
-    if not os.path.exists(DIR):
-        os.makedirs(DIR)
-    if not os.path.exists(filename):  # or os.stat(filename).st_size == 0:  # if file does not exist or empty
-        global last_fetch
-        while time.time() - last_fetch < wait_time:
-            time.sleep(0.1)
-        last_fetch = time.time()
-        r = requests.get(URL, params=params)
-        raw = r.text
+    raw_store = open_store(DIR)
+    period = get_period(params)
+    print("Fetching: {} {}".format(site_id, period))
+    raw = raw_store.get(site_id, 'xml', period)
+    if raw is None:
+        with limiter:
+            raw = http_client.get(URL, params=params).text
         if 'Invalid site id' in raw or 'Invalid XMLfeed request' in raw or 'Unknown or bad timezone' in raw or len(raw) == 0:
             return ''
-        with open(filename, 'w+') as f:
-            try:
-                f.write(raw)
-            except UnicodeEncodeError:
-                return fetch(site_id, start, end)
-    else:
-        with open(filename, 'r') as f:
-            raw = f.read()
-
+        raw_store.put(site_id, 'xml', period, raw)
     return raw
 
 
@@ -56,45 +74,140 @@ def get_stored_datetimes():
     return None, None
 
 
-def get_hourly_production(site_id, start, end):
-    production = []
-    for st, sp in time_batches(start, end):
-        production.append(fetch(site_id, st, sp))
-    plot_days(production)
+# returns Wh produced in the window of the xml, or nan if there is no production_tag
+# raises ET.ParseError if the xml is broken, e.g. a body cut off by a dropped connection
+def parse_production(raw, chunk_size=16384):
+    parser = ET.XMLPullParser(['end'])
+    total, found = 0.0, False
+    for i in range(0, len(raw) + chunk_size, chunk_size):
+        if i < len(raw):
+            parser.feed(raw[i:i + chunk_size])
+        else:
+            parser.close()  # only closing finds a document that ends early
+        for _, element in parser.read_events():
+            if element.tag == production_tag and element.text and element.text.strip():
+                total += float(element.text)
+                found = True
+            element.clear()  # not keeping parsed elements in memory
+    return total if found else np.nan
+
+
+# parse_production() of the xml of one window of the site; nan if there is none or it is broken, so one bad
+# response only leaves its window empty instead of failing the site
+def parse_window(site_id, window, raw):
+    if not raw:
+        return np.nan
+    try:
+        return parse_production(raw)
+    except ET.ParseError as e:
+        print('Skipped broken xml of {} {} - {}: {}'.format(site_id, *window, e))
+        return np.nan
+
+
+# returns the names of elements of the xml with a number, e.g. to find which one is production_tag
+def get_numeric_tags(raw):
+    tags = []
+    for element in ET.fromstring(raw).iter():
+        try:
+            float((element.text or '').strip())
+        except ValueError:
+            continue
+        if element.tag not in tags:
+            tags.append(element.tag)
+    return tags
+
+
+# returns a dataframe of production in Wh ('AC Power', like fetcher_csv) per window starting at its index
+# resolution - size of windows, e.g. {'hours': 1}; max_window if None, which needs the fewest requests
+# workers - windows fetched at a time (all of them still go through the shared limiter)
+def get_production(site_id, start, end, resolution=None, workers=8):
+    windows = [(st, min(sp, end)) for st, sp in time_batches(start, end, resolution or max_window)]
+    with ThreadPoolExecutor(workers) as pool:
+        raws = list(pool.map(lambda window: fetch_retrying(site_id, *window), windows))
+    values = np.array([parse_window(site_id, window, raw) for window, raw in zip(windows, raws)], dtype=np.float64)
+    if np.isnan(values).all() and any(raws):  # e.g. the feed names its production differently
+        print('No <{}> in the xml of {}, elements with numbers: {}'.format(
+            production_tag, site_id, get_numeric_tags(next(raw for raw in raws if raw))))
+    df = pd.DataFrame({'AC Power': values}, index=pd.DatetimeIndex([st for st, _ in windows]))
+    df.columns.name = str(site_id)
+    return df
+
+
+def get_hourly_production(site_id, start, end, workers=8):
+    production = get_production(site_id, start, end, {'hours': 1}, workers)
+    plot_days(production['AC Power'].to_numpy())
     print(production)
+    return production
+
+
+# same as fetch(), but retries a broken connection up to max_attempts times; returns None if all of them failed
+def fetch_retrying(site_id, start, end):
+    for attempt in range(max_attempts):
+        try:
+            return fetch(site_id, start, end)
+        except requests.exceptions.ConnectionError:  # nothing is stored for an interrupted fetch
+            print('Interrupted: {}'.format(site_id))
+            time.sleep(backoff * 2 ** attempt)
+    return None
+
+
+# returns values of metadata_tags from the xml, '' for missing ones
+# the xml is parsed as a stream and parsing stops once all tags are found, e.g. before the production of the site
+def parse_metadata(raw, chunk_size=16384):
+    parser = ET.XMLPullParser(['end'])
+    vals = {}
+    for i in range(0, len(raw), chunk_size):
+        parser.feed(raw[i:i + chunk_size])
+        for _, element in parser.read_events():
+            if element.tag in metadata_tags and element.tag not in vals:
+                vals[element.tag] = (element.text or '').strip().replace('?', '')
+        if len(vals) == len(metadata_tags):
+            break
+    return {tag: vals.get(tag, '') for tag in metadata_tags}
 
 
 def get_site_metadata(site_id):
-    raw = fetch(site_id, *get_stored_datetimes())
+    raw = fetch_retrying(site_id, *get_stored_datetimes())
     if not raw:  # if xml is empty
         return None
     try:
-        xml = ET.fromstring(raw)
+        return parse_metadata(raw)
     except ET.ParseError:
         print(site_id)
         return None
 
-    vals = {}
-    for tag in metadata_tags:
-        res = xml.find(".//" + tag).text
-        if res:
-            vals[tag] = res.strip().replace('?', '')
-        else:
-            vals[tag] = ""
-    return vals
 
+# fetches active solectria_sites metadata, 'workers' sites at a time, and stores it in a csv
+# every site is appended to the csv as soon as it is fetched, so an interrupted run continues with the sites
+# that are not in the file yet (unless resume=False, which starts a new file)
+# returns the dataframe of the metadata of active_sites
+def get_active_sites_metadata(active_sites, filename='active_sites_data.csv', workers=8, resume=True):
+    columns = ['site_id'] + metadata_tags
+    done = set()
+    if resume and os.path.exists(filename):
+        with open(filename, newline='') as f:
+            reader = csv.reader(f)
+            columns = next(reader, columns)  # keeping other columns of the file, e.g. 'fetch_id'
+            done = {row[0] for row in reader if row}
+    else:
+        with open(filename, 'w', newline='') as f:
+            csv.writer(f).writerow(columns)
+
+    with open(filename, 'a', newline='') as f, ThreadPoolExecutor(workers) as pool:
+        writer = csv.DictWriter(f, columns, restval='', extrasaction='ignore')
+        futures = {pool.submit(get_site_metadata, site): site for site in active_sites if str(site) not in done}
+        print('Fetching metadata of {} sites ({} already stored)'.format(len(futures), len(active_sites) - len(futures)))
+        for future in as_completed(futures):
+            data = future.result()
+            if not data:  # if None
+                continue
+            data['site_id'] = futures[future]
+            writer.writerow(data)
+            f.flush()
 
-# fetches active solectria_sites metadata, stores it in a csv
-def get_active_sites_metadata(active_sites):
-    df = pd.DataFrame(columns=metadata_tags)
-
-    for site in active_sites:
-        data = get_site_metadata(site)
-        if not data:  # if None
-            continue
-        df = df.append(pd.Series(data, name=site))
-    df.to_csv('active_sites_data.csv', index_label='site_id')
-    return df
+    df = pd.read_csv(filename, dtype=str, keep_default_na=False, index_col=0)
+    df.index = df.index.astype(int)
+    return df.loc[[site for site in active_sites if site in df.index], metadata_tags]
 
 
 def get_active_sites(filename='active_sites.txt'):
@@ -104,20 +217,13 @@ def get_active_sites(filename='active_sites.txt'):
         return sites
 
 
-def fetch_active_sites(sites):
+# fetches metadata xml of sites into the store, 'workers' at a time; returns sites that could not be fetched
+def fetch_active_sites(sites, workers=8):
     # solectria_sites = get_active_sites()
-    for site in sites:
-        while True:  # to try fetching until no error
-            try:
-                fetch(site, *get_stored_datetimes())
-            except requests.exceptions.ConnectionError:
-                print('Interrupted')
-                try:
-                    os.remove(get_filename(get_params(site, *get_stored_datetimes())))
-                except:
-                    pass
-                time.sleep(6.0)
-                continue
-            else:
-                break
+    with ThreadPoolExecutor(workers) as pool:
+        raws = list(pool.map(lambda site: fetch_retrying(site, *get_stored_datetimes()), sites))
+    failed = [site for site, raw in zip(sites, raws) if raw is None]
+    if failed:
+        print('Could not fetch:', failed)
+    return failed
 
@@ -0,0 +1,79 @@
+import json
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:  # without pyarrow parsed frames are not cached
+    pa = None
+
+# dataframes returned by fetcher_csv.parse() stored as Arrow IPC files named by the sha1 of the raw .csv,
+# so a stored response doesn't need to be parsed again
+# all frames of one .csv share the index, so they are kept in one table:
+#   'Timeframe', '0/AC Energy', '0/AC Power', ..., '1/AC Energy', ..., '2/Ambient', ...
+# with the frame names (columns.name) and their column names in the schema's metadata
+# frames of a download that is replaced in the raw store (an open period fetched again) are removed with it,
+# prune() removes all that no stored download refers to anymore
+
+
+def get_filename(directory, digest):
+    return os.path.join(directory, digest + '.arrow')
+
+
+def save(directory, digest, dfs):
+    if pa is None:
+        return
+    os.makedirs(directory, exist_ok=True)
+    index = dfs[0].index if dfs else pd.DatetimeIndex([])
+    arrays, names = [pa.array(index.values)], ['Timeframe']
+    for i, df in enumerate(dfs):
+        for col in df.columns:
+            arrays.append(pa.array(df[col].to_numpy()))
+            names.append('{}/{}'.format(i, col))
+    frames = [[df.columns.name, list(df.columns)] for df in dfs]
+    table = pa.Table.from_arrays(arrays, names=names).replace_schema_metadata({'frames': json.dumps(frames)})
+
+    filename = get_filename(directory, digest)
+    with pa.OSFile(filename + '.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(filename + '.tmp', filename)  # never leaving a half-written file under the final name
+
+
+# deletes the frames cached for the digest, if any
+def remove(directory, digest):
+    try:
+        os.remove(get_filename(directory, digest))
+    except FileNotFoundError:
+        pass
+
+
+# deletes cached frames of all digests not in 'digests' (e.g. those of raw_store.RawStore.entries());
+# returns the number of files deleted
+def prune(directory, digests):
+    if not os.path.isdir(directory):
+        return 0
+    n = 0
+    for name in os.listdir(directory):
+        if name.endswith('.arrow') and name[:-len('.arrow')] not in digests:
+            remove(directory, name[:-len('.arrow')])
+            n += 1
+    return n
+
+
+# returns the list of dataframes stored for the digest, or None if they are not cached
+def load(directory, digest):
+    filename = get_filename(directory, digest)
+    if pa is None or not os.path.exists(filename):
+        return None
+    # columns are read straight from the mapped file; the map is closed when the table is no longer referenced
+    table = pa.ipc.open_file(pa.memory_map(filename, 'r')).read_all()
+    index = pd.DatetimeIndex(table.column(0).to_numpy())
+    dfs = []
+    for i, (name, columns) in enumerate(json.loads(table.schema.metadata[b'frames'])):
+        df = pd.DataFrame({col: table.column('{}/{}'.format(i, col)).to_numpy() for col in columns}, index=index,
+                          columns=columns)
+        df.columns.name = name
+        dfs.append(df)
+    return dfs
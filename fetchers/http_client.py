@@ -0,0 +1,81 @@
+import hashlib
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HOSTS = ['https://solrenview.com', 'http://solrenview.com']  # hosts that can be redirected to a stub server
+timeout = (10, 60)  # seconds to connect, seconds to wait for a response
+pool_connections = 4  # number of hosts to keep pools for
+pool_maxsize = 8  # keep-alive connections per host, should be >= max number of requests in flight
+
+session = None
+session_lock = threading.Lock()
+host_override = None  # e.g.: 'http://127.0.0.1:8000' to replay recorded responses from fetchers/stub_server.py
+record_dir = None  # if set, every response body is saved there for the stub server
+stats = threading.local()  # bytes received by each thread
+
+
+# one session for the whole process: connections are kept alive and reused by all fetchers and threads
+def get_session():
+    global session
+    if session is None:
+        with session_lock:
+            if session is None:
+                s = requests.Session()
+                s.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+                adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True)
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                session = s
+    return session
+
+
+# drops pooled connections, e.g. after changing pool sizes
+def reset_session():
+    global session
+    with session_lock:
+        if session is not None:
+            session.close()
+        session = None
+
+
+# sends all requests to solrenview to 'host' instead (None to stop)
+def redirect_to(host):
+    global host_override
+    host_override = host.rstrip('/') if host else None
+
+
+# saves all responses to 'directory' (None to stop)
+def record_to(directory):
+    global record_dir
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    record_dir = directory
+
+
+# returns number of bytes of response bodies received by the current thread so far
+def get_bytes_received():
+    return getattr(stats, 'bytes', 0)
+
+
+# name of the file with the recorded response for a request path, e.g. '/cgi-bin/cgihandler.cgi?view=0,1,2,1&...'
+def get_record_name(path_url):
+    return hashlib.sha1(path_url.encode()).hexdigest() + '.body'
+
+
+def get(url, params=None, **kwargs):
+    if host_override:
+        for host in HOSTS:
+            if url.startswith(host):
+                url = host_override + url[len(host):]
+                break
+    r = get_session().get(url, params=params, timeout=kwargs.pop('timeout', timeout), **kwargs)
+    stats.bytes = get_bytes_received() + len(r.content)
+    if record_dir and r.ok:
+        with open(os.path.join(record_dir, get_record_name(r.request.path_url)), 'wb') as f:
+            f.write(r.content)
+        with session_lock, open(os.path.join(record_dir, 'index.txt'), 'a') as f:  # paths to replay in benchmarks
+            f.write(r.request.path_url + '\n')
+    return r
@@ -0,0 +1,108 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from db.helper_db import ensure_tables, require_postgres, run_query
+from db import rollup
+from db.registry import Registry
+from fetchers import fetcher_csv, http_client
+
+# ingests production of many Solectria sites into the database, keeping track of every site in the 'ingest_job' table
+# (site, period, status, attempts, duration, bytes), so an interrupted run continues where it stopped when started
+# again with the same period, and failed sites are retried with a growing delay
+# statuses: 'pending', 'running' (or interrupted), 'done', 'empty' (no data), 'failed' (retried later)
+
+max_attempts = 5
+backoff = 60  # seconds before the first retry of a failed site, doubled with every attempt
+
+
+def add_jobs(site_ids, start, end):
+    if len(site_ids) == 0:
+        return
+    run_query("INSERT INTO ingest_job (site_id, period_start, period_end) "
+              "SELECT unnest(%(site_ids)s::varchar[]), %(start)s::timestamp, %(end)s::timestamp ON CONFLICT DO NOTHING",
+              params={'site_ids': list(map(str, site_ids)), 'start': start, 'end': end})
+
+
+# returns jobs of the period that are not finished yet: [{'site_id': ..., 'attempts': ..., 'ready': ...}, ...]
+# 'ready' is False for failed jobs still waiting for their retry
+def get_jobs(start, end):
+    jobs = run_query(
+        "SELECT site_id, attempts, status != 'failed' OR updated_on + interval '1 second' * {backoff} * "
+        "2 ^ (attempts - 1) <= NOW() AS ready FROM ingest_job "
+        "WHERE period_start = %(start)s AND period_end = %(end)s AND status NOT IN ('done', 'empty') "
+        "AND attempts < {max_attempts} ORDER BY site_id".format(backoff=backoff, max_attempts=max_attempts),
+        params={'start': start, 'end': end})
+    if jobs is None:
+        raise RuntimeError('Could not read ingest_job')
+    return jobs
+
+
+# attempted - counts one more attempt; values - other columns to set, e.g.: duration=1.5
+def set_status(site_id, start, end, status, attempted=False, **values):
+    sets = ['status = %(status)s', 'updated_on = NOW()'] + (['attempts = attempts + 1'] if attempted else [])
+    sets += ['{0} = %({0})s'.format(column) for column in values]
+    params = {column: value[:1000] if isinstance(value, str) else value for column, value in values.items()}
+    params.update(status=status, site_id=str(site_id), start=start, end=end)
+    run_query("UPDATE ingest_job SET {} WHERE site_id = %(site_id)s AND period_start = %(start)s "
+              "AND period_end = %(end)s".format(', '.join(sets)), params=params)
+
+
+# returns status of the job after running it
+def run_job(site_id, start, end, interval, incremental, registry):
+    set_status(site_id, start, end, 'running')
+    t = time.time()
+    n_bytes = http_client.get_bytes_received()
+    try:
+        ok = fetcher_csv.collect_data(int(site_id), start, end, interval, incremental=incremental, registry=registry)
+    except Exception as e:
+        status, error = 'failed', '{}: {}'.format(type(e).__name__, e)
+    else:
+        status, error = ('done' if ok else 'empty'), ''
+    set_status(site_id, start, end, status, True, duration=round(time.time() - t, 3),
+               bytes=http_client.get_bytes_received() - n_bytes, error=error)
+    print('Site {}: {} in {:.1f}s {}'.format(site_id, status, time.time() - t, error))
+    return status
+
+
+# prints and returns the number of jobs of the period per status
+def report(start, end):
+    rows = run_query("SELECT status, count(*) AS n, sum(duration) AS duration, sum(bytes) AS bytes FROM ingest_job "
+                     "WHERE period_start = %(start)s AND period_end = %(end)s GROUP BY status",
+                     params={'start': start, 'end': end}) or []
+    for row in rows:
+        print('{:<8} {:>6} sites {:>12}s {:>14} bytes'.format(*map(str, (row['status'], row['n'], row['duration'],
+                                                                         row['bytes']))))
+    return {row['status']: row['n'] for row in rows}
+
+
+# ingests production of sites for [start, end) with 'workers' sites at a time
+# rate, in_flight - limit of requests to solrenview shared by all workers (see fetcher_csv.set_rate_limit)
+# incremental - sites only fetch production after the latest one of [start, end) in the database, so a retried site
+# doesn't download again what it already stored (storing again would be safe, see db.helper_db.merge_keys)
+def run(site_ids, start, end, interval=60, workers=8, rate=2, in_flight=8, incremental=True):
+    require_postgres('Ingesting')  # ingest_job and the rollups are PostgreSQL tables
+    fetcher_csv.set_rate_limit(rate, in_flight)
+    ensure_tables(['ingest_job'] + rollup.tables)  # added after the first schema, see db.helper_db.ensure_tables
+    add_jobs(site_ids, start, end)
+    registry = Registry()
+    pool = ThreadPoolExecutor(workers)
+    try:
+        while True:
+            jobs = get_jobs(start, end)
+            if len(jobs) == 0:
+                break
+            ready = [job['site_id'] for job in jobs if job['ready']]
+            if len(ready) == 0:  # only failed sites waiting for a retry
+                time.sleep(min(backoff, 10))
+                continue
+            futures = [pool.submit(run_job, site_id, start, end, interval, incremental, registry) for site_id in ready]
+            for future in as_completed(futures):
+                future.result()
+            registry.flush()
+    except KeyboardInterrupt:  # running sites stay 'running' and are picked up again by the next run
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        registry.flush()
+        pool.shutdown()
+    return report(start, end)
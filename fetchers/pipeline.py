@@ -0,0 +1,191 @@
+import multiprocessing
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from db.registry import Registry
+from fetchers import frame_cache
+from fetchers.fetcher_csv import DIR, PARSED_DIR, fetch, get_missing_range, get_stored, get_views, interval_unit, \
+    is_empty_period, parse, store_site_data, trim_production
+from fetchers.raw_store import open_store
+
+# collect_data() as a pipeline of three stages connected by bounded queues, so the period N+1 is downloaded while
+# the period N is parsed and the period N-1 is written to the database:
+#   fetch (threads) -> queue -> parse (processes) -> queue -> COPY (calling thread)
+# a stage that gets ahead blocks on its full queue, so memory doesn't grow with the length of the range;
+# periods are numbered by their view and stored in that order
+
+DONE = None  # put into a queue by a stage when it has nothing more
+poll = 0.1  # seconds between checks of the stop event while waiting on a queue
+parse_pool = None  # (workers, ProcessPoolExecutor) reused by all calls, see get_parse_pool()
+parse_pool_lock = threading.Lock()
+
+
+# returns the process pool parsing views, made once per process (again if 'workers' changes or it broke)
+# spawned rather than forked: forking while the fetch threads are running could copy a held lock
+def get_parse_pool(workers):
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is None or parse_pool[0] != workers or parse_pool[1]._broken:
+            if parse_pool is not None:
+                parse_pool[1].shutdown(wait=False, cancel_futures=True)
+            parse_pool = (workers, ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')))
+        return parse_pool[1]
+
+
+def close_parse_pool():
+    global parse_pool
+    with parse_pool_lock:
+        if parse_pool is not None:
+            parse_pool[1].shutdown()
+            parse_pool = None
+
+
+# puts the item into the queue unless 'stop' is set while it is full; returns whether it was put
+def put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=poll)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# returns the next item of the queue, or DONE once 'stop' is set
+def get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=poll)
+        except queue.Empty:
+            continue
+    return DONE
+
+
+# fetch stage: takes (number, view) from 'views' until it is empty, puts (number, raw or cached frames, digest)
+# into 'fetched'; 'ahead' limits the views taken but not stored yet, so a slow view can't let the others pile up
+# an exception is passed on instead of data, to be raised in the calling thread
+def fetch_views(site_id, views, fetched, ahead, stop):
+    try:
+        while not stop.is_set():
+            if not ahead.acquire(timeout=poll):
+                continue
+            try:
+                number, view = views.get_nowait()
+            except queue.Empty:
+                ahead.release()
+                break
+            key, entry = get_stored(view, site_id)
+            dfs = None if entry is None else frame_cache.load(PARSED_DIR, entry.digest)
+            if dfs is not None:
+                put(fetched, (number, dfs, None), stop)
+                continue
+            raw = fetch(view, site_id)
+            entry = open_store(DIR).lookup(*key)
+            put(fetched, (number, raw, None if entry is None else entry.digest), stop)
+    except Exception as e:
+        put(fetched, (number, e, None), stop)
+    finally:
+        put(fetched, DONE, stop)
+
+
+# parse stage: sends raw .csv from 'fetched' to the process pool, puts (number, future of frames, digest)
+# into 'parsed'
+def parse_views(pool, fetched, n_fetchers, parsed, stop):
+    while n_fetchers > 0:
+        item = get(fetched, stop)
+        if item is DONE:
+            if stop.is_set():
+                return
+            n_fetchers -= 1
+            continue
+        number, data, digest = item
+        future = Future()
+        if isinstance(data, str):
+            try:
+                future = pool.submit(parse, data)
+            except Exception as e:  # e.g. a broken pool
+                future.set_exception(e)
+        elif isinstance(data, Exception):
+            future.set_exception(data)
+        else:  # frames from the cache
+            future.set_result(data)
+        put(parsed, (number, future, digest), stop)
+    put(parsed, DONE, stop)
+
+
+# same as fetcher_csv.collect_data, but each period is stored as soon as it and all periods before it are parsed:
+# periods are stored in the order of views (through a reorder buffer), so the watermark of the incremental mode
+# never gets past a period that failed or wasn't stored because the process stopped
+# the first exception stops all stages and is raised; periods before it are already stored
+# fetch_workers - views downloaded at a time, parse_workers - processes parsing them (see get_parse_pool)
+# queue_size - max number of periods waiting between two stages
+def collect_data(site_id, start, end, interval=10, fetch_workers=2, parse_workers=2, queue_size=4,
+                 incremental=False, registry=None):
+    flush = registry is None
+    if flush:
+        registry = Registry()
+    if incremental:
+        start, end = get_missing_range(site_id, start, end, interval)
+        if start >= end:
+            return True
+    t = time.time()
+    views = queue.Queue()
+    for number, view in enumerate(get_views(site_id, start, end, interval_unit[interval])):
+        views.put((number, view))
+    fetched = queue.Queue(queue_size)
+    parsed = queue.Queue(queue_size)
+    ahead = threading.Semaphore(fetch_workers + 2 * queue_size)
+    stop = threading.Event()
+
+    pool = get_parse_pool(parse_workers)
+    threads = [threading.Thread(target=fetch_views, args=(site_id, views, fetched, ahead, stop), daemon=True)
+               for _ in range(fetch_workers)]
+    threads.append(threading.Thread(target=parse_views, args=(pool, fetched, fetch_workers, parsed, stop),
+                                    daemon=True))
+    for thread in threads:
+        thread.start()
+    n_periods = 0
+    waiting = {}  # number -> (future, digest) of periods parsed before the ones preceding them
+    next_number = 0
+    try:
+        while True:
+            item = parsed.get()
+            if item is DONE:
+                break
+            waiting[item[0]] = item[1:]
+            while next_number in waiting:
+                future, digest = waiting.pop(next_number)
+                next_number += 1
+                dfs = future.result()
+                if digest is not None:
+                    frame_cache.save(PARSED_DIR, digest, dfs)
+                ahead.release()
+                if is_empty_period(dfs):
+                    continue
+                dfs = trim_production(dfs, start, end)
+                if len(dfs[0]) == 0:  # period only partly in [start, end) and the part was empty
+                    continue
+                store_site_data(site_id, dfs, registry)
+                n_periods += 1
+        if waiting:  # a stage stopped without passing on a period
+            raise RuntimeError('Period of view {} of site {} is missing'.format(next_number, site_id))
+    finally:
+        stop.set()  # no-op if all stages are done, otherwise they stop waiting on their queues
+        for q in [views, fetched, parsed]:
+            while True:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if q is parsed and item is not DONE:
+                    waiting[item[0]] = item[1:]
+        for future, _ in waiting.values():  # parses not started yet
+            future.cancel()
+        for thread in threads:
+            thread.join()
+    if flush:
+        registry.flush()
+    print('Time fetching, parsing & inserting {} periods:'.format(n_periods), time.time() - t)
+    return n_periods > 0
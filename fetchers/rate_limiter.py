@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+# token bucket shared between threads: at most 'rate' requests per second on average (bursts of up to 'burst'),
+# and at most 'max_in_flight' requests running at the same time
+# usage:
+#   limiter = RateLimiter(2, 4)
+#   with limiter:
+#       requests.get(...)
+class RateLimiter:
+    def __init__(self, rate, max_in_flight=1, burst=None):
+        self.lock = threading.Lock()
+        self.local = threading.local()  # semaphore taken by each thread, in case configure() replaces it meanwhile
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.configure(rate, max_in_flight, burst)
+
+    # changes limits; requests already waiting pick up the new rate on their next check
+    def configure(self, rate, max_in_flight=None, burst=None):
+        with self.lock:
+            self.rate = float(rate)
+            if max_in_flight is not None:
+                self.max_in_flight = max_in_flight
+                self.in_flight = threading.BoundedSemaphore(max_in_flight)
+            self.burst = float(burst if burst is not None else max(1, self.max_in_flight))
+            self.tokens = min(getattr(self, 'tokens', self.burst), self.burst)
+            self.updated = time.monotonic()
+
+    # blocks until a token is available and takes it
+    def acquire_token(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def __enter__(self):
+        slot = self.in_flight
+        slot.acquire()
+        try:
+            self.acquire_token()
+        except BaseException:
+            slot.release()
+            raise
+        self.local.slots = getattr(self.local, 'slots', []) + [slot]
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.local.slots.pop().release()
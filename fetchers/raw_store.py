@@ -0,0 +1,194 @@
+import gzip
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+
+try:
+    import zstandard
+except ImportError:  # falling back to gzip
+    zstandard = None
+
+# raw downloads of a fetcher kept in one directory as:
+#   blobs.pack   - compressed responses appended one after another
+#   manifest.tsv - one line per response: site_id, view, period -> where its blob is in blobs.pack
+# the manifest is loaded into memory once, so checking whether a response is stored needs no disk access;
+# a response stored again for the same key replaces the previous one (the last line wins); the replaced blobs
+# stay in blobs.pack until compact() rewrites it, which open_store() does once they take compact_ratio of it
+
+MANIFEST = 'manifest.tsv'
+PACK = 'blobs.pack'
+TMP = '.tmp'  # suffix of the files written by compact()
+compact_ratio = 0.5  # share of blobs.pack taken by replaced blobs at which open_store() compacts it
+compact_min_bytes = 64 * 1024 * 1024  # replaced blobs of a smaller size are never worth compacting
+
+# site_id - str, view - e.g. 'week' or 'xml', period - e.g. '2020-02-24', codec - 'zstd' or 'gzip',
+# digest - sha1 of the raw text, fetched_at - unix time, name - original file name (e.g. the server's .csv name)
+Entry = namedtuple('Entry', ['site_id', 'view', 'period', 'offset', 'length', 'codec', 'digest', 'fetched_at',
+                             'name'])
+
+stores = {}  # directory -> RawStore
+stores_lock = threading.Lock()
+
+
+def compress(data):
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=10).compress(data)
+    return 'gzip', gzip.compress(data, compresslevel=6)
+
+
+def decompress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class RawStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.index = {}  # (site_id, view, period) -> Entry
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+        if os.path.exists(self.path(MANIFEST)):
+            with open(self.path(MANIFEST), 'r') as f:
+                for line in f:
+                    values = line.rstrip('\n').split('\t')
+                    if len(values) != len(Entry._fields):  # line cut by a crash while writing
+                        continue
+                    entry = Entry(*values[:3], int(values[3]), int(values[4]), values[5], values[6],
+                                  float(values[7]), values[8])
+                    self.index[entry[:3]] = entry
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # finishes or discards a compact() that was interrupted: the new manifest without the new pack means the pack
+    # was already replaced, otherwise the old files are still complete
+    def recover(self):
+        if os.path.exists(self.path(MANIFEST + TMP)) and not os.path.exists(self.path(PACK + TMP)):
+            os.replace(self.path(MANIFEST + TMP), self.path(MANIFEST))
+        for name in [PACK + TMP, MANIFEST + TMP]:
+            if os.path.exists(self.path(name)):
+                os.remove(self.path(name))
+
+    # returns the Entry of a stored response or None
+    def lookup(self, site_id, view, period):
+        return self.index.get((str(site_id), view, str(period)))
+
+    # returns the stored raw text or None
+    def get(self, site_id, view, period):
+        entry = self.lookup(site_id, view, period)
+        return None if entry is None else self.read(entry)
+
+    # returns the raw text of the entry's key (its latest blob, in case compact() moved or dropped the entry's)
+    def read(self, entry):
+        with self.lock:
+            entry = self.index.get(entry[:3], entry)
+            with open(self.path(PACK), 'rb') as f:
+                f.seek(entry.offset)
+                data = f.read(entry.length)
+        return decompress(entry.codec, data).decode('utf-8')
+
+    # stores raw text, returns its Entry
+    def put(self, site_id, view, period, raw, name='', fetched_at=None):
+        data = raw.encode('utf-8')
+        codec, blob = compress(data)
+        with self.lock:
+            with open(self.path(PACK), 'ab') as f:
+                offset = f.tell()
+                f.write(blob)
+            entry = Entry(str(site_id), view, str(period), offset, len(blob), codec, hashlib.sha1(data).hexdigest(),
+                          time.time() if fetched_at is None else fetched_at, name)
+            with open(self.path(MANIFEST), 'a') as f:  # written after the blob, so it never points to missing data
+                f.write('\t'.join(map(str, entry)) + '\n')
+            self.index[entry[:3]] = entry
+        return entry
+
+    # returns the number of bytes of blobs.pack taken by replaced blobs
+    def get_garbage(self):
+        if not os.path.exists(self.path(PACK)):
+            return 0
+        return os.path.getsize(self.path(PACK)) - sum(entry.length for entry in list(self.index.values()))
+
+    # rewrites blobs.pack with only the latest blob of every key and the manifest to match; returns bytes freed
+    # the new pack and manifest are written next to the old ones, then replace them (see recover())
+    def compact(self):
+        with self.lock:
+            if not os.path.exists(self.path(PACK)):
+                return 0
+            index = {}
+            with open(self.path(PACK), 'rb') as src, open(self.path(PACK + TMP), 'wb') as dst:
+                for entry in sorted(self.index.values(), key=lambda e: e.offset):
+                    src.seek(entry.offset)
+                    index[entry[:3]] = entry._replace(offset=dst.tell())
+                    dst.write(src.read(entry.length))
+                dst.flush()
+                os.fsync(dst.fileno())
+            with open(self.path(MANIFEST + TMP), 'w') as f:
+                f.writelines('\t'.join(map(str, entry)) + '\n' for entry in index.values())
+                f.flush()
+                os.fsync(f.fileno())
+            freed = os.path.getsize(self.path(PACK)) - os.path.getsize(self.path(PACK + TMP))
+            os.replace(self.path(PACK + TMP), self.path(PACK))
+            os.replace(self.path(MANIFEST + TMP), self.path(MANIFEST))
+            self.index = index
+        return freed
+
+    # returns Entries of all stored responses, optionally only for one view
+    def entries(self, view=None):
+        return [entry for entry in list(self.index.values()) if view is None or entry.view == view]
+
+
+# returns the RawStore of a directory, opening it once per process (and compacting it if replaced blobs take
+# more than compact_ratio of the pack)
+def open_store(directory):
+    with stores_lock:
+        if directory not in stores:
+            store = RawStore(directory)
+            garbage = store.get_garbage()
+            if garbage > compact_min_bytes and garbage > compact_ratio * os.path.getsize(store.path(PACK)):
+                print('Compacted {}: {} bytes freed'.format(directory, store.compact()))
+            stores[directory] = store
+        return stores[directory]
+
+
+# moves all files of an old raw directory (one file per response) into its store
+# get_key - function of a file name returning (site_id, view, period) or None to skip the file
+# remove - deletes files after they are stored
+def migrate(directory, get_key, remove=False):
+    store = open_store(directory)
+    n = 0
+    for name in sorted(os.listdir(directory)):
+        if name in (MANIFEST, PACK, MANIFEST + TMP, PACK + TMP):
+            continue
+        key = get_key(name)
+        if key is None:
+            print('Skipped:', name)
+            continue
+        filename = os.path.join(directory, name)
+        with open(filename, 'r') as f:
+            store.put(*key, f.read(), name=name, fetched_at=os.path.getmtime(filename))
+        if remove:
+            os.remove(filename)
+        n += 1
+    print('Migrated {} files from {}'.format(n, directory))
+    return n
+
+
+# python -m fetchers.raw_store [--remove] - moves solectria_raw_csv/ and solectria_raw_xml/ into stores
+# python -m fetchers.raw_store compact - drops replaced blobs of both stores and parsed frames of no stored .csv
+if __name__ == '__main__':
+    from fetchers import fetcher_csv, fetcher_xml, frame_cache
+
+    for directory, get_key in [(fetcher_csv.DIR, fetcher_csv.get_key_from_file_name),
+                               (fetcher_xml.DIR, fetcher_xml.get_key_from_file_name)]:
+        if sys.argv[1:2] == ['compact']:
+            print('Compacted {}: {} bytes freed'.format(directory, open_store(directory).compact()))
+            if directory == fetcher_csv.DIR:
+                digests = {entry.digest for entry in open_store(directory).entries()}
+                print('Pruned {} cached frames'.format(frame_cache.prune(fetcher_csv.PARSED_DIR, digests)))
+        else:
+            migrate(directory, get_key, '--remove' in sys.argv)
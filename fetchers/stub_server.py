@@ -0,0 +1,71 @@
+import gzip
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fetchers.http_client import get_record_name
+
+# replays solrenview responses recorded with fetchers.http_client.record_to(directory), so fetchers can be run and
+# benchmarked offline:
+#   python -m fetchers.stub_server recorded_responses 8000
+#   http_client.redirect_to('http://127.0.0.1:8000')
+
+
+def make_handler(directory, latency=0.0):
+    cache = {}  # record name -> (raw body, gzipped body)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+        disable_nagle_algorithm = True  # otherwise headers and body sent separately wait for a delayed ACK
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)  # imitating the round trip to solrenview
+            name = get_record_name(self.path)
+            if name not in cache:
+                try:
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        body = f.read()
+                except FileNotFoundError:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                cache[name] = (body, gzip.compress(body))
+            body, gzipped = cache[name]
+            self.send_response(200)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzipped
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Type', 'text/csv' if self.path.endswith('.csv') else 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+# latency - seconds added to every response
+def serve(directory, port=8000, latency=0.0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(directory, latency))
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+# starts the server in a background thread, returns it with its address, e.g.: 'http://127.0.0.1:51234'
+# stop with server.shutdown()
+def start(directory, port=0, latency=0.0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(directory, latency))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 8000,
+          float(sys.argv[3]) if len(sys.argv) > 3 else 0.0)
@@ -0,0 +1,309 @@
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+# offline benchmarks for the fetching/ingesting pipeline
+# usage: python -m misc.benchmark <name> [args...], e.g.: python -m misc.benchmark http recorded_responses
+
+
+# prints and returns the best time of 'repeat' runs of f()
+def timeit(name, f, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    print('{:<45} {:>10.4f}s'.format(name, best))
+    return best
+
+
+# bare requests.get vs the pooled keep-alive client, both against the stub server replaying 'directory'
+# latency - seconds the stub server waits before each response
+def bench_http(directory, latency=0.02, workers=4):
+    import requests
+    from fetchers import http_client, stub_server
+
+    latency, workers = float(latency), int(workers)
+    with open(os.path.join(directory, 'index.txt')) as f:
+        paths = list(dict.fromkeys(line.strip() for line in f if line.strip()))
+    server, host = stub_server.start(directory, latency=latency)
+    try:
+        def bare(path):
+            with requests.get(host + path) as r:
+                return len(r.content)
+
+        def pooled(path):
+            with http_client.get('https://solrenview.com' + path) as r:
+                return len(r.content)
+
+        http_client.redirect_to(host)
+        print(len(paths), 'recorded requests')
+        timeit('requests.get, serial', lambda: [bare(p) for p in paths], 1)
+        timeit('http_client.get, serial', lambda: [pooled(p) for p in paths], 1)
+        with ThreadPoolExecutor(workers) as pool:
+            timeit('requests.get, {} threads'.format(workers), lambda: list(pool.map(bare, paths)), 1)
+            timeit('http_client.get, {} threads'.format(workers), lambda: list(pool.map(pooled, paths)), 1)
+    finally:
+        http_client.redirect_to(None)
+        server.shutdown()
+
+
+# synthetic solrenview .csv in the format parsed by fetcher_csv.parse
+# every 'null_every'th value of an inverter is '(null,null,null)'
+def make_inverter_csv(n_inverters, n_rows, weather=True, freq='1min', null_every=7):
+    names, columns, units = [''], ['Timeframe'], ['']
+    for k in range(n_inverters):
+        names += ['inv#{}  - {}  (PVI 28TL)'.format(k + 1, 1013021546296 + k), '', '']
+        columns += ['AC Energy', 'AC Power', 'AC Current']
+        units += ['kWh', 'W', 'A']
+    if weather:
+        names += ['Weather (Station 1)']
+        columns += ['Ambient', 'Module', 'Irradiance', 'Wind Direction', 'Wind Speed']
+        units += ['C', 'C', 'W/m2', 'deg', 'm/s']
+    lines = ['Quad 7 - Phase 2 (Inverter-Direct, Day of 2020-02-23)', ','.join(names), ','.join(columns),
+             ','.join(units)]
+    rng = np.random.default_rng(0)
+    for r, t in enumerate(pd.date_range('2020-02-23', periods=n_rows, freq=freq)):
+        cells = ['[{}]'.format(t)]
+        for k in range(n_inverters):
+            if (r + k) % null_every == 0:
+                cells += ['(null', 'null', 'null)']
+            else:
+                cells += ['{:.2f}'.format(rng.random() * 100), str(int(rng.random() * 30000)),
+                          '{:.1f}'.format(rng.random() * 40)]
+        if weather:
+            cells += ['{:.1f}'.format(v) for v in rng.random(5) * 30]
+        lines.append(','.join(cells))
+    return '\n'.join(lines) + '\n'
+
+
+# fetcher_csv.parse before it was rewritten to a single pass, kept as the baseline for bench_parse
+# (np.split of a dataframe replaced with the equivalent iloc slices, which also works on newer pandas)
+def legacy_parse(raw):
+    raw = raw[raw.index('inv') - 1:]
+    i = raw.index('Timeframe')
+    raw = raw[:i] + raw[i:].replace('(', '').replace(')', '')
+    inverters_raw = raw[:raw.index('Timeframe')].strip().split(',')
+    if 'Weather' in inverters_raw[-1]:
+        j = raw.index('Weather')
+        i = raw[j:].index(')')
+        raw = raw[:i + j + 1] + ',,,,' + raw[i + j + 1:]
+    indexes = [i - 1 for i in range(len(inverters_raw)) if inverters_raw[i] != '' and i != 1]
+    csv = pd.read_csv(StringIO(raw))
+    csv.set_index(csv.columns[0], inplace=True)
+    indexes.append(len(csv.columns))
+    dfs = []
+    prev_i = 0
+    for i in indexes:
+        dfs.append(csv[csv.columns[prev_i:i]])
+        prev_i = i
+    dfs_fin = []
+    for df in dfs:
+        rows = [df.iloc[:1], df.iloc[1:2], df.iloc[2:].copy()]
+        main_df = rows[2]
+        main_df.columns = list(rows[0].iloc[0])
+        main_df.index = list(map(lambda x: x[1:-1], rows[2].index))
+        main_df.fillna(0, inplace=True)
+        if 'inv' in rows[0].columns[0]:
+            main_df["AC Power"] = main_df["AC Power"].astype(int)
+            main_df["AC Energy"] = main_df["AC Energy"].astype(float)
+            main_df["AC Current"] = main_df["AC Current"].astype(float)
+        elif 'Weather' in rows[0].columns[0]:
+            for col in main_df.columns:
+                main_df[col] = main_df[col].astype(float)
+        main_df.columns.name = rows[0].columns[0]
+        dfs_fin.append(main_df)
+    return dfs_fin
+
+
+# legacy vs single-pass fetcher_csv.parse on synthetic day (1-minute) and week (10-minute) views
+def bench_parse(repeat=3):
+    import warnings
+    from fetchers.fetcher_csv import parse
+
+    warnings.simplefilter('ignore', pd.errors.DtypeWarning)  # legacy_parse reads the names row as data
+    for n_inverters, n_rows in [(4, 1440), (20, 1440), (50, 1440), (20, 1008), (50, 10080)]:
+        raw = make_inverter_csv(n_inverters, n_rows)
+        print('{} inverters x {} rows ({:.1f} MB)'.format(n_inverters, n_rows, len(raw) / 1e6))
+        old = timeit('  legacy parse', lambda: legacy_parse(raw), int(repeat))
+        new = timeit('  fetcher_csv.parse', lambda: parse(raw), int(repeat))
+        print('  speedup: {:.1f}x'.format(old / new))
+
+
+# peak memory of serializing component_production for COPY: whole-frame copy + StringIO (the old fetcher_csv.store)
+# vs streaming chunks through db.helper_db.IteratorFile; no database needed, the text is read like copy_from does
+def bench_store_memory(n_rows=2000000):
+    import tracemalloc
+    from db.helper_db import IteratorFile, iter_copy_text
+
+    n_rows = int(n_rows)
+    df = pd.DataFrame({'component_id': '1013021546296', 'AC Energy': np.random.rand(n_rows),
+                       'AC Power': np.random.randint(0, 30000, n_rows), 'AC Current': np.random.rand(n_rows)},
+                      index=pd.date_range('2015-01-01', periods=n_rows, freq='1min'))
+    drop = ['AC Energy', 'AC Current']
+
+    def legacy():
+        frame = df.copy()
+        frame.rename(columns={'AC Power': 'value'}, inplace=True)
+        frame.drop(drop, axis=1, inplace=True)
+        frame.insert(0, 'unit', 'Wh')
+        output = StringIO()
+        frame.to_csv(output, sep='\t', header=False)
+        output.seek(0)
+        while output.read(65536):
+            pass
+
+    def streaming():
+        output = IteratorFile(iter_copy_text(df, ['component_id', 'AC Power'], {'unit': 'Wh'}, True))
+        while output.read(65536):
+            pass
+
+    print('{} rows ({:.0f} MB dataframe)'.format(n_rows, df.memory_usage(deep=True).sum() / 1e6))
+    for name, f in [('copy + StringIO', legacy), ('streaming chunks', streaming)]:
+        tracemalloc.start()
+        t = time.perf_counter()
+        f()
+        t = time.perf_counter() - t
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('  {:<20} peak {:>8.1f} MB {:>8.2f}s'.format(name, peak / 1e6, t))
+
+
+# concatenating period after period (the old get_historical_data) vs fetcher_csv.combine_periods, on day views
+# (1440 1-minute rows) of 'n_inverters' inverters from 1 month to 5 years; the old way is only timed up to
+# 'legacy_days' since it grows quadratically
+def bench_concat(n_inverters=4, legacy_days=366):
+    from fetchers.fetcher_csv import combine_periods
+
+    n_inverters, legacy_days = int(n_inverters), int(legacy_days)
+    day = pd.DataFrame({'AC Energy': np.random.rand(1440), 'AC Power': np.random.randint(0, 30000, 1440),
+                        'AC Current': np.random.rand(1440)})
+    periods = []
+    for d in range(5 * 365 + 1):
+        index = pd.date_range('2015-01-01', periods=1440, freq='1min') + pd.Timedelta(days=d)
+        periods.append([day.set_axis(index) for _ in range(n_inverters)])
+
+    def legacy(n_days):
+        total = None
+        for data in periods[:n_days]:
+            if not total:
+                total = list(data)  # not modifying the first period
+                continue
+            for j in range(len(total)):
+                total[j] = pd.concat([total[j], data[j]])
+
+    for name, n_days in [('1 month', 31), ('6 months', 183), ('1 year', 366), ('2 years', 731), ('5 years', 1826)]:
+        print('{} ({} day views x {} inverters)'.format(name, n_days, n_inverters))
+        if n_days <= legacy_days:
+            timeit('  concat per period', lambda: legacy(n_days), 1)
+        t = timeit('  combine_periods', lambda: combine_periods(periods[:n_days]), 3)
+        print('  {:.1f} us per day view'.format(t / n_days * 1e6))
+
+
+# EXPLAIN ANALYZE of a year of daily sums of 20 sites (the query of average_daily_efficiency) on synthetic
+# 15-minute production of 'n_sites' sites and the size of the tables: the schema before v2 (heap, no indexes) vs v2
+# (monthly partitions, btree (site_id, date), brin (date)) vs v2 with compact columns (integer site_id, smallint
+# unit code), which production doesn't use yet; needs the database of database.ini, creates and drops bench_* tables
+def bench_schema(n_rows=100000000, n_sites=1000, keep=False):
+    from db.helper_db import run_queries, run_query, table_queries
+    from db.partitions import ensure_partitions
+
+    n_rows, n_sites = int(n_rows), int(n_sites)
+    start = datetime(2015, 1, 1)
+    end = start + timedelta(minutes=15 * (n_rows // n_sites + 1))
+    rows = ("SELECT 'S' || (i % {n_sites}), 'INVERTER', "
+            "'{start}'::timestamp + interval '15 minutes' * (i / {n_sites}), (random() * 5000)::int, 'Wh', NOW() "
+            "FROM generate_series(0, {last}) AS i").format(
+        n_sites=n_sites, start=start, last=n_rows - 1)
+    # v2 production, its default partition and indexes under other names
+    v2 = [re.sub(r'\bproduction', 'bench_production_v2', q) for q in table_queries['production'][1:]]
+    compact = [re.sub(r'\bproduction', 'bench_production_v2c', q).replace('site_id VARCHAR(30)', 'site_id integer')
+               .replace('unit VARCHAR(10)', 'unit smallint') for q in table_queries['production'][1:]]
+    tables = ['bench_production_v1', 'bench_production_v2', 'bench_production_v2c']
+    t = time.perf_counter()
+    run_queries(['DROP TABLE IF EXISTS {} CASCADE'.format(', '.join('public.' + table for table in tables)),
+                 'CREATE TABLE public.bench_production_v1 (LIKE public.production INCLUDING DEFAULTS)'] + v2 + compact)
+    ensure_partitions('bench_production_v2', start, end)
+    ensure_partitions('bench_production_v2c', start, end)
+    run_queries(['INSERT INTO public.bench_production_v1 ' + rows,
+                 'INSERT INTO public.bench_production_v2 SELECT * FROM public.bench_production_v1',
+                 'INSERT INTO public.bench_production_v2c SELECT substr(site_id, 2)::int, measured_by, date, value, 1, '
+                 'created_on FROM public.bench_production_v1'] + ['ANALYZE public.' + table for table in tables])
+    print('{} rows of {} sites loaded in {:.0f}s'.format(n_rows, n_sites, time.perf_counter() - t))
+
+    query_start = end - timedelta(days=365)
+    site_numbers = range(0, n_sites, max(1, n_sites // 20))
+    for table in tables:
+        sites = ', '.join(str(i) if table.endswith('c') else "'S{}'".format(i) for i in site_numbers)
+        plan = run_query("EXPLAIN (ANALYZE, BUFFERS) SELECT site_id, date_trunc('day', date), sum(value), count(value) "
+                         "FROM public.{} WHERE date >= '{}' AND date < '{}' AND site_id IN ({}) GROUP BY 1, 2"
+                         .format(table, query_start, end, sites))
+        lines = [row['QUERY PLAN'] for row in plan]
+        size = run_query("SELECT sum(pg_total_relation_size(inhrelid)) AS size FROM pg_inherits "
+                         "WHERE inhparent = 'public.{}'::regclass".format(table))[0]['size'] \
+            or run_query("SELECT pg_total_relation_size('public.{}') AS size".format(table))[0]['size']
+        print('{} ({:.0f} MB with indexes)'.format(table, size / 2 ** 20))
+        for line in lines[:12] + [line for line in lines[12:] if 'Time' in line]:
+            print('  ' + line)
+    if not keep:
+        run_query('DROP TABLE IF EXISTS {} CASCADE'.format(', '.join('public.' + table for table in tables)))
+
+
+# planning and execution time of a year of daily sums of 10, 100 and 1000 sites (the query of rollup.get_rollup on
+# the raw table): ids and dates formatted into the text (a new query, parsed and planned every time) vs bound
+# parameters with '= ANY(%(site_ids)s)', prepared once per connection (see helper_db.execute)
+# server times are means of 'repeat' EXPLAIN ANALYZE, client times the best of 'repeat' run_query() calls;
+# needs the database of database.ini with production in 'table' (missing sites are padded with unknown ids)
+def bench_params(repeat=20, table='production'):
+    from db.helper_db import execute, run_query, transaction
+
+    repeat = int(repeat)
+    end = run_query('SELECT max(date) AS date FROM public.{}'.format(table))[0]['date']
+    start = end - timedelta(days=365)
+    known = [row['site_id'] for row in run_query('SELECT DISTINCT site_id FROM public.{} LIMIT 1000'.format(table))]
+    select = "SELECT site_id, date_trunc('day', date), sum(value), count(value) FROM public.{} ".format(table)
+    bound = select + 'WHERE date >= %(start)s AND date < %(end)s AND site_id = ANY(%(site_ids)s) GROUP BY 1, 2'
+
+    def server_times(cur, explain, values=None):
+        times = {'Planning': 0.0, 'Execution': 0.0}
+        for _ in range(repeat):
+            cur.execute('EXPLAIN (ANALYZE) ' + explain, values)
+            for (line,) in cur.fetchall():
+                match = re.match(r'(Planning|Execution) Time: ([\d.]+) ms', line)
+                if match:
+                    times[match.group(1)] += float(match.group(2)) / repeat
+        return times
+
+    for n_sites in [10, 100, 1000]:
+        site_ids = known[:n_sites] + ['unknown_{}'.format(i) for i in range(n_sites - len(known[:n_sites]))]
+        params = {'start': start, 'end': end, 'site_ids': site_ids}
+        formatted = select + "WHERE date >= '{}' AND date < '{}' AND site_id IN ({}) GROUP BY 1, 2".format(
+            start, end, ', '.join("'{}'".format(site_id) for site_id in site_ids))
+        with transaction() as cur:
+            literal = server_times(cur, formatted)
+            execute(cur, bound, params)  # prepares it on this connection
+            cur.fetchall()
+            name, names = cur.connection.prepared[bound]
+            prepared = server_times(cur, 'EXECUTE {} ({})'.format(name, ', '.join(['%s'] * len(names))),
+                                    [params[n] for n in names])
+        print('{} sites ({} ids known)'.format(n_sites, min(n_sites, len(known))))
+        for kind, times in [('formatted IN list', literal), ('prepared = ANY', prepared)]:
+            print('  {:<20} planning {:>8.3f} ms, execution {:>9.3f} ms'.format(kind, times['Planning'],
+                                                                              times['Execution']))
+        timeit('  run_query, formatted IN list', lambda: run_query(formatted, True), repeat)
+        timeit('  run_query, prepared = ANY', lambda: run_query(bound, True, params=params), repeat)
+
+
+benchmarks = {'http': bench_http, 'parse': bench_parse, 'store_memory': bench_store_memory, 'concat': bench_concat,
+              'schema': bench_schema, 'params': bench_params}
+
+if __name__ == '__main__':
+    benchmarks[sys.argv[1]](*sys.argv[2:])
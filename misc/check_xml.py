@@ -0,0 +1,34 @@
+import sys
+from datetime import datetime
+
+from dateutil.relativedelta import relativedelta
+
+from fetchers import fetcher_xml, http_client, stub_server
+
+# checks fetcher_xml.production_tag against a recorded response of the xml feed, replayed by fetchers.stub_server
+# (responses are recorded by fetching with http_client.record_to(directory))
+# usage: python -m misc.check_xml <site_id> <day, e.g. 2020-01-01> <recorded responses>
+
+
+# fetches the production of a day of the site from the stub server replaying 'directory' and prints whether
+# production_tag is in it; returns the production, or None if no response of that day is recorded
+def check_production_tag(site_id, day, directory):
+    server, host = stub_server.start(directory)
+    http_client.redirect_to(host)
+    try:  # not through fetcher_xml.fetch(), which would answer from the raw store and keep the response in it
+        params = fetcher_xml.get_params(site_id, day, day + relativedelta(**fetcher_xml.max_window))
+        raw = http_client.get(fetcher_xml.URL, params=params).text
+    finally:
+        http_client.redirect_to(None)
+        server.shutdown()
+    if not raw:
+        print('No recorded response of {} for {}'.format(site_id, day))
+        return None
+    tags = fetcher_xml.get_numeric_tags(raw)
+    print('<{}> {}, elements with numbers: {}'.format(
+        fetcher_xml.production_tag, 'found' if fetcher_xml.production_tag in tags else 'MISSING', tags))
+    return fetcher_xml.parse_production(raw)
+
+
+if __name__ == '__main__':
+    check_production_tag(sys.argv[1], datetime.strptime(sys.argv[2], '%Y-%m-%d'), sys.argv[3])
@@ -119,8 +119,9 @@ def plot_days_inter(production, entries_per_day=24, filename='day_plot'):
 
 # 'start' and 'end' - datetime or timestamp
 def time_batches(start, end, interval={'hours': 1}, include_end=False):
+    step = relativedelta(**interval)
     while end > start:
-        yield start, start + relativedelta(**interval)
-        start += relativedelta(**interval)
+        yield start, start + step
+        start += step
     if include_end:  # when start == end, yield end
-        start, start + relativedelta(**interval)
+        start, start + step